@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+'''Benchmarks for dynamic-perfect-hashing
+
+Drives DynamicPerfectHashing through a set of workloads and writes the
+results as JSON, so runs of different versions can be compared:
+
+    python benchmarks/bench.py --size 100000 --seed 1 --output results.json
+
+For every workload the report has ops/sec and p50/p99/max latency per
+operation, the statistics() of the structure at the end (RehashAll count
+and duration, retries, space usage) and the peak memory (measured in a
+second, untimed run under tracemalloc).
+'''
+
+import argparse
+import bisect
+import itertools
+import json
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+# use weird import because of invalid module name
+dph = __import__('dynamic-perfect-hashing')
+
+UNIVERSE_SIZE = 2 ** 40
+
+
+def sequential(rng, size):
+    '''Insert 0..size-1 in order, then look all of them up'''
+    operations = [('Insert', key) for key in range(size)]
+    operations += [('Locate', key) for key in range(size)]
+    return operations
+
+
+def uniform(rng, size):
+    '''Insert uniform random keys, then as many lookups with about half hits'''
+    keys = [rng.randrange(UNIVERSE_SIZE) for _ in range(size)]
+    operations = [('Insert', key) for key in keys]
+    operations += [('Locate', rng.choice(keys) if rng.random() < 0.5 else rng.randrange(UNIVERSE_SIZE))
+                   for _ in range(size)]
+    return operations
+
+
+def zipf(rng, size, exponent=1.1):
+    '''Inserts and lookups mixed 1:1, keys drawn from a Zipf distribution'''
+    keys = [rng.randrange(UNIVERSE_SIZE) for _ in range(size)]
+    cumulative = list(itertools.accumulate(1 / rank ** exponent for rank in range(1, size + 1)))
+
+    operations = []
+    for _ in range(2 * size):
+        key = keys[bisect.bisect(cumulative, rng.random() * cumulative[-1])]
+        operations.append(('Insert' if rng.random() < 0.5 else 'Locate', key))
+    return operations
+
+
+def churn(rng, size):
+    '''Fill up, then replace elements by deleting one and inserting another'''
+    live = [rng.randrange(UNIVERSE_SIZE) for _ in range(size)]
+    live = list(dict.fromkeys(live))
+    operations = [('Insert', key) for key in live]
+    for _ in range(size):
+        index = rng.randrange(len(live))
+        operations.append(('Delete', live[index]))
+        live[index] = rng.randrange(UNIVERSE_SIZE)
+        operations.append(('Insert', live[index]))
+    return operations
+
+
+def lookup_heavy(rng, size):
+    '''Preload, then 95% lookups and 5% inserts'''
+    keys = [rng.randrange(UNIVERSE_SIZE) for _ in range(size)]
+    operations = [('Insert', key) for key in keys]
+    for _ in range(2 * size):
+        if rng.random() < 0.05:
+            key = rng.randrange(UNIVERSE_SIZE)
+            keys.append(key)
+            operations.append(('Insert', key))
+        else:
+            operations.append(('Locate', rng.choice(keys)))
+    return operations
+
+
+WORKLOADS = {
+    'sequential': sequential,
+    'uniform': uniform,
+    'zipf': zipf,
+    'churn': churn,
+    'lookup_heavy': lookup_heavy,
+}
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def summarize(latencies):
+    '''ops/sec and latency percentiles in microseconds for a list of nanoseconds'''
+    latencies.sort()
+    total = sum(latencies)
+    return {
+        'count': len(latencies),
+        'ops_per_sec': len(latencies) / (total / 1e9) if total else None,
+        'p50_us': percentile(latencies, 0.5) / 1e3,
+        'p99_us': percentile(latencies, 0.99) / 1e3,
+        'max_us': latencies[-1] / 1e3,
+    }
+
+
+def run(operations, options):
+    '''Run the operations once with timing, returns the report of the run'''
+    dynperf = dph.DynamicPerfectHashing(UNIVERSE_SIZE, stats=True, **options)
+
+    latencies = {}
+    clock = time.perf_counter_ns
+    start = clock()
+    for name, key in operations:
+        method = getattr(dynperf, name)
+        before = clock()
+        method(key)
+        latencies.setdefault(name, []).append(clock() - before)
+    wall = (clock() - start) / 1e9
+
+    return {
+        'wall_seconds': wall,
+        'ops_per_sec': len(operations) / wall,
+        'operations': {name: summarize(values) for name, values in sorted(latencies.items())},
+        'statistics': dynperf.statistics(),
+    }
+
+
+def peak_memory(operations, options):
+    '''Peak traced memory in bytes of an untimed run'''
+    tracemalloc.start()
+    try:
+        dynperf = dph.DynamicPerfectHashing(UNIVERSE_SIZE, **options)
+        for name, key in operations:
+            getattr(dynperf, name)(key)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=100000, help='elements per workload')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--workloads', default=','.join(WORKLOADS),
+                        help='comma separated, out of ' + ', '.join(WORKLOADS))
+    parser.add_argument('--incremental', action='store_true', help='use the incremental RehashAll')
+    parser.add_argument('--hash-family', default='carter-wegman', choices=sorted(dph.HASH_FAMILIES),
+                        help='hash functions of the top level and the subtables')
+    parser.add_argument('--no-memory', action='store_true', help='skip the peak memory run')
+    parser.add_argument('--output', help='write the JSON here instead of stdout')
+    args = parser.parse_args(argv)
+
+    options = {'incremental': args.incremental, 'hash_family': args.hash_family}
+    report = {
+        'meta': {
+            'python': platform.python_version(),
+            'numpy': getattr(dph.np, '__version__', None),
+            'size': args.size,
+            'seed': args.seed,
+            'options': options,
+        },
+        'workloads': {},
+    }
+
+    for name in args.workloads.split(','):
+        operations = WORKLOADS[name](random.Random(args.seed), args.size)
+
+        # the structure draws its hash functions from the global generator
+        random.seed(args.seed)
+        result = run(operations, options)
+        if not args.no_memory:
+            random.seed(args.seed)
+            result['peak_memory_bytes'] = peak_memory(operations, options)
+        report['workloads'][name] = result
+        print('{}: {:.0f} ops/sec'.format(name, result['ops_per_sec']), file=sys.stderr)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as report_file:
+            report_file.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
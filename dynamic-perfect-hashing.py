@@ -1,21 +1,550 @@
 #!/usr/bin/env python3
 '''Implementation of dynamic perfect hashing'''
 
+import contextlib
+import functools
+import gc
+import hashlib
+import itertools
 import math
+import multiprocessing
+import os
 import random
+import struct
+import threading
+import time
+import zlib
+from collections import Counter
+from array import array
+from mmap import ACCESS_COPY, ACCESS_READ, mmap as map_file
+from multiprocessing import resource_tracker, shared_memory
+
+# numpy is optional, only the batch operations use it
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# with these bases Miller-Rabin is deterministic for every n < 3.3 * 10^24,
+# which covers 64-bit universes with lots of room to spare
+MILLER_RABIN_BASES = (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41)
+
+def is_prime(n):
+    '''Deterministic Miller-Rabin primality test'''
+    if n < 2:
+        return False
+
+    for base in MILLER_RABIN_BASES:
+        if n % base == 0:
+            return n == base
+
+    # write n - 1 as d * 2^r with d odd
+    d = n - 1
+    r = 0
+    while d % 2 == 0:
+        d //= 2
+        r += 1
+
+    for base in MILLER_RABIN_BASES:
+        x = pow(base, d, n)
+        if x == 1 or x == n - 1:
+            continue
+        for _ in range(r - 1):
+            x = x * x % n
+            if x == n - 1:
+                break
+        else:
+            return False
+
+    return True
+
+# the extended precision trick in mulmod_many needs a 64-bit mantissa
+LONG_DOUBLE_MULMOD = np is not None and np.finfo(np.longdouble).nmant >= 63
+
+# buckets at least this large search for an injective function with numpy,
+# testing a whole round of candidates at once
+VECTORIZED_INJECTIVE_THRESHOLD = 16
+INJECTIVE_CANDIDATES = 8
+
+# retry budgets. Once this many top level functions in a row fail (**) the
+# search escalates, see escalate, and a subtable that has seen this many
+# candidates fail at one size gets twice the slots. Both searches usually
+# succeed within a handful of tries.
+TOP_LEVEL_BUDGET = 16
+INJECTIVE_BUDGET = 32
+# escalations of the top level search in order, the last one repeats
+ESCALATIONS = ('grow_s', 'larger_prime', 'switch_family', 'grow_M')
+
+# the pool of an incremental RehashAll is allocated in one go, with one
+# MIGRATION_HEADROOMth of its slots on top for the tables the replayed
+# writes grow
+MIGRATION_HEADROOM = 8
+
+# number of keys per task of a parallel rebuild
+PARALLEL_CHUNK = 65536
+
+# the hashed form takes about 500 to 750 bytes per element: slots, Table
+# and HashFunction objects and the subtable arrays. Automatic storage
+# switches to a bitmap of the universe once that is smaller than this many
+# bytes per element.
+HASHED_BYTES_PER_ELEMENT = 512
+STORAGE_MODES = ('hashed', 'auto', 'bitmap')
+
+# a concurrent batch lookup that keeps overlapping subtable rebuilds falls
+# back to Locate after this many tries
+CONCURRENT_RETRIES = 4
+
+# snapshot layout: header, then offset and length in bytes of every section,
+# then the sections themselves, each starting at a multiple of 8. Everything
+# is in the byte order of the machine that wrote it, the byte order mark
+# makes load refuse files from the other kind of machine.
+SNAPSHOT_MAGIC = b'DPHSNAP2'
+SNAPSHOT_BYTE_ORDER_MARK = 0x0102030405060708
+SNAPSHOT_HEADER = struct.Struct('=8sQQQQQQQQQ16s')
+SNAPSHOT_SECTIONS = ('sub_table_k', 'sub_table_space', 'sub_table_offset', 'element_count',
+                     'max_element_count', 'values', 'occupied')
+SNAPSHOT_INDEX = struct.Struct('=' + 'QQ' * len(SNAPSHOT_SECTIONS))
+
+def read_snapshot(buffer):
+    '''Check a snapshot in buffer, returns its header values and its sections as views'''
+    if len(buffer) < SNAPSHOT_HEADER.size + SNAPSHOT_INDEX.size:
+        raise ValueError('Not a snapshot')
+    header = SNAPSHOT_HEADER.unpack_from(buffer)
+    if header[0] != SNAPSHOT_MAGIC:
+        raise ValueError('Not a snapshot')
+    if header[1] != SNAPSHOT_BYTE_ORDER_MARK:
+        raise ValueError('Snapshot was written with a different byte order')
+
+    index = SNAPSHOT_INDEX.unpack_from(buffer, SNAPSHOT_HEADER.size)
+    sections = {}
+    for name, offset, length in zip(SNAPSHOT_SECTIONS, index[::2], index[1::2]):
+        section = buffer[offset:offset + length]
+        sections[name] = section if name == 'occupied' else section.cast('Q')
+
+    family = header[-1].rstrip(b'\0').decode()
+    if family not in HASH_FAMILIES:
+        raise ValueError('Snapshot uses the unknown hash family {!r}'.format(family))
+
+    # universe_size, prime, k, s, count, M, sub_table_space_total, slots,
+    # hash family
+    return header[2:-1] + (HASH_FAMILIES[family],), sections
+
+# frozen layout: header, then k, allocated space and offset of every
+# subtable and then the slots, same byte order rules as snapshots
+FROZEN_MAGIC = b'DPHFROZ1'
+FROZEN_HEADER = struct.Struct('=8sQQQQQQQ16s')
+
+# journal layout: header, then frames of a length and crc32 followed by
+# records. A record is an operation byte and an element or, for the batch
+# operations, an operation byte, a count and that many elements. A widen
+# record holds the new universe size instead of an element, the header has
+# the universe at the start of the journal. A frame is written per group
+# commit, a crash leaves at most the last one incomplete. Byte order is
+# that of the machine, like snapshots.
+JOURNAL_MAGIC = b'DPHJRNL1'
+JOURNAL_HEADER = struct.Struct('=8sQQ')
+JOURNAL_FRAME = struct.Struct('=II')
+JOURNAL_RECORD = struct.Struct('=BQ')
+JOURNAL_INSERT, JOURNAL_DELETE, JOURNAL_INSERT_MANY, JOURNAL_DELETE_MANY = 1, 2, 3, 4
+JOURNAL_WIDEN = 5
+# elements per batch record, keeps frames far below the 4 GiB a length holds
+JOURNAL_BATCH = 65536
+FSYNC_POLICIES = ('always', 'commit', 'never')
+
+def read_journal(path):
+    '''Read the intact frames of a journal
+
+    Returns the universe size after the last widening (None for a missing
+    or empty journal), the elements of all records in order as an
+    array('Q'), whether each of them was inserted (1) or deleted (0) as a
+    bytearray and the length of the intact part of the file.
+    '''
+    try:
+        with open(path, 'rb') as journal:
+            data = journal.read()
+    except FileNotFoundError:
+        data = b''
+
+    elements = array('Q')
+    present = bytearray()
+    if len(data) < JOURNAL_HEADER.size:
+        return None, elements, present, 0
+    magic, byte_order_mark, universe_size = JOURNAL_HEADER.unpack_from(data)
+    if magic != JOURNAL_MAGIC:
+        raise ValueError('Not a journal')
+    if byte_order_mark != SNAPSHOT_BYTE_ORDER_MARK:
+        raise ValueError('Journal was written with a different byte order')
+
+    position = JOURNAL_HEADER.size
+    while position + JOURNAL_FRAME.size <= len(data):
+        length, checksum = JOURNAL_FRAME.unpack_from(data, position)
+        start = position + JOURNAL_FRAME.size
+        frame = data[start:start + length]
+        if len(frame) < length or zlib.crc32(frame) != checksum:
+            break
+
+        offset = 0
+        while offset < length:
+            operation, value = JOURNAL_RECORD.unpack_from(frame, offset)
+            offset += JOURNAL_RECORD.size
+            if operation in (JOURNAL_INSERT, JOURNAL_DELETE):
+                elements.append(value)
+                present.append(operation == JOURNAL_INSERT)
+            elif operation == JOURNAL_WIDEN:
+                universe_size = value
+            else:
+                elements.frombytes(frame[offset:offset + 8 * value])
+                present.extend(bytes([operation == JOURNAL_INSERT_MANY]) * value)
+                offset += 8 * value
+        position = start + length
+
+    return universe_size, elements, present, position
+
+def next_prime(n):
+    '''Returns the smallest prime larger than n'''
+    if n < 2:
+        return 2
+
+    candidate = n + 1 if n % 2 == 0 else n + 2
+    while not is_prime(candidate):
+        candidate += 2
+
+    return candidate
+
+def mulmod_many(k, keys, prime):
+    '''k * keys mod prime on uint64 arrays, k is a scalar or an array'''
+    k = np.asarray(k, dtype=np.uint64)
+
+    if prime <= 2 ** 32:
+        # k and the keys are smaller than the prime, the product fits
+        return k * keys % np.uint64(prime)
+
+    if LONG_DOUBLE_MULMOD and prime < 2 ** 62:
+        # the quotient in extended precision is off by at most one, the
+        # remainder is computed with wrapping 64-bit arithmetic and corrected
+        quotient = (k.astype(np.longdouble) * keys.astype(np.longdouble) / prime).astype(np.uint64)
+        remainder = (k * keys - quotient * np.uint64(prime)).view(np.int64)
+        remainder = np.where(remainder < 0, remainder + prime, remainder)
+        remainder = np.where(remainder >= prime, remainder - prime, remainder)
+        return remainder.view(np.uint64)
+
+    # exact, but goes through python ints
+    return (k.astype(object) * keys.astype(object) % prime).astype(np.uint64)
+
+def sub_table_slots(max_element_count, compact):
+    '''Slots a subtable for max_element_count elements needs, before rounding
+
+    2m(m-1) as in the paper or, compact, m(m-1)/2 but at least m. A quarter
+    of the slots, in return the injective search needs about e instead of
+    about 1.3 candidates and same size rebuilds come about four times as
+    often. Works on ints and on numpy arrays.
+    '''
+    if not compact:
+        return 2 * max_element_count * (max_element_count - 1)
+    half = max_element_count * (max_element_count - 1) // 2
+    if np is not None and isinstance(half, np.ndarray):
+        return np.maximum(max_element_count, half)
+    return max(max_element_count, half)
+
+def build_sub_tables(keys, bucket_sizes, prime, seed, family, compact=False):
+    '''Search injective functions for consecutive buckets and fill their slots
+
+    keys are sorted by bucket. k is drawn for every subtable at once and
+    redrawn only for the ones that are not injective. As the regions don't
+    overlap, a collision anywhere in the slots is a collision within one
+    subtable. A subtable that runs out of INJECTIVE_BUDGET attempts at one
+    size gets twice the slots, the regions behind it move along. Returns k,
+    the allocated space, the slot values, the occupied locations and the
+    number of attempts of every subtable. Parallel rebuilds run this in
+    worker processes, so it only takes and returns arrays.
+    '''
+    # same sizes as Table.update
+    max_element_count = 2 * bucket_sizes
+    space = family.table_sizes(np.maximum(1, sub_table_slots(max_element_count, compact)))
+    offset = np.cumsum(space) - space
+    j = np.repeat(np.arange(len(bucket_sizes)), bucket_sizes)
+
+    rng = np.random.default_rng(seed)
+    k = np.zeros(len(bucket_sizes), dtype=np.uint64)
+    attempts = np.zeros(len(bucket_sizes), dtype=np.intp)
+    pending = np.arange(len(bucket_sizes))
+    while len(pending):
+        k[pending] = family.draw_many(rng, prime, len(pending))
+        attempts[pending] += 1
+        location = offset[j] + family.hash_arrays(k[j], space[j].astype(np.uint64), keys,
+                                                  prime).astype(np.intp)
+
+        sorted_location = np.sort(location)
+        collisions = sorted_location[1:][sorted_location[1:] == sorted_location[:-1]]
+        pending = np.unique(np.searchsorted(offset, collisions, side='right') - 1)
+
+        exhausted = pending[attempts[pending] % INJECTIVE_BUDGET == 0]
+        if len(exhausted):
+            space[exhausted] = family.table_sizes(2 * space[exhausted])
+            offset = np.cumsum(space) - space
+
+    values = np.zeros(int(space.sum()), dtype=np.uint64)
+    values[location] = keys
+    return k, space, values, location, attempts
+
+# fingerprints are reduced modulo the Mersenne prime 2^61 - 1, so the
+# universe for them is [0, 2^61 - 2] and its prime is small enough for the
+# fast paths of mulmod_many
+FINGERPRINT_UNIVERSE = 2 ** 61 - 2
+
+def key_bytes(key):
+    '''Stable encoding of a key, keys that compare equal are encoded the same'''
+    if isinstance(key, str):
+        return b's' + key.encode('utf-8', 'surrogatepass')
+    if isinstance(key, (bytes, bytearray, memoryview)):
+        return b'b' + bytes(key)
+    if isinstance(key, float) and key.is_integer():
+        # 1.0 == 1
+        key = int(key)
+    if isinstance(key, int):
+        return b'i' + key.to_bytes(key.bit_length() // 8 + 1, 'little', signed=True)
+    if isinstance(key, float):
+        return b'f' + struct.pack('<d', key)
+    if isinstance(key, tuple):
+        parts = [key_bytes(item) for item in key]
+        return b't' + b''.join(struct.pack('<Q', len(part)) + part for part in parts)
+    if key is None:
+        return b'n'
+    raise TypeError('Keys have to be str, bytes, int, float, tuple or None')
+
+def fingerprint(key):
+    '''64-bit BLAKE2b of the encoded key, reduced into FINGERPRINT_UNIVERSE'''
+    digest = hashlib.blake2b(key_bytes(key), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') % (FINGERPRINT_UNIVERSE + 1)
+
+def fingerprint_many(keys):
+    '''fingerprint for a batch of keys, as a uint64 array if numpy is there'''
+    keys = list(keys)
+    blake2b = hashlib.blake2b
+    modulus = FINGERPRINT_UNIVERSE + 1
+    # str batches skip the dispatch of key_bytes
+    if all(type(key) is str for key in keys):
+        fingerprints = [
+            int.from_bytes(blake2b(b's' + key.encode('utf-8', 'surrogatepass'),
+                                   digest_size=8).digest(), 'little') % modulus
+            for key in keys]
+    else:
+        fingerprints = [fingerprint(key) for key in keys]
+
+    if np is None:
+        return fingerprints
+    return np.array(fingerprints, dtype=np.uint64)
+
+def serialized(method):
+    '''Run a write operation under the writer lock of concurrent mode'''
+    @functools.wraps(method)
+    def locked(self, *args, **kwargs):
+        if self.lock is None:
+            return method(self, *args, **kwargs)
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return locked
+
+def journaled(operation):
+    '''Record a successful scalar write in the journal, if there is one'''
+    def decorator(method):
+        @functools.wraps(method)
+        def logged(self, element):
+            result = method(self, element)
+            if self.journal is not None:
+                self.journal.append(operation, element)
+            return result
+        return logged
+    return decorator
+
+def locate_slots(hash_function, values, occupied, sub_table_k, sub_table_space,
+                 sub_table_offset, keys):
+    '''Vectorized Locate on the flat arrays of a set of tables'''
+    j = hash_function.hash_many(keys)
+    k = np.frombuffer(sub_table_k, dtype=np.uint64)[j]
+    space = np.frombuffer(sub_table_space, dtype=np.uint64)[j]
+    location = (np.frombuffer(sub_table_offset, dtype=np.uint64)[j]
+                + hash_function.hash_arrays(k, space, keys, hash_function.prime))
+
+    occupied = np.frombuffer(occupied, dtype=np.uint8)
+    values = np.frombuffer(values, dtype=np.uint64)
+    bits = occupied[location >> np.uint64(3)] >> (location & np.uint64(7)).astype(np.uint8) & 1
+    return (bits == 1) & (values[location] == keys)
+
+def key_bits(keys):
+    '''Byte index and bit mask of every key of a uint64 array in a bitmap'''
+    return keys >> np.uint64(3), np.uint8(1) << (keys & np.uint64(7)).astype(np.uint8)
+
+def key_array(elements, universe_size):
+    '''Returns the elements as a uint64 array, checks the universe bounds once'''
+    keys = np.asarray(elements)
+    if keys.ndim == 0:
+        # sets, generators and other iterables numpy doesn't unpack
+        keys = np.asarray(list(elements))
+
+    if not keys.size:
+        return np.zeros(0, dtype=np.uint64)
+
+    if keys.dtype.kind not in 'iuO':
+        raise TypeError('Elements have to be integers')
+
+    if (keys.min() < 0 or keys.max() > universe_size):
+        raise ValueError('Element is outside of universe')
+
+    return keys.astype(np.uint64).ravel()
+
+def rechunk(pieces, size):
+    '''Regroup a stream of uint64 arrays, array('Q') without numpy, into chunks of size
+
+    Only the last chunk may be shorter.
+    '''
+    if np is None:
+        buffer = array('Q')
+        for piece in pieces:
+            buffer.extend(piece)
+            while len(buffer) >= size:
+                yield buffer[:size]
+                del buffer[:size]
+        if buffer:
+            yield buffer
+        return
+
+    pending = []
+    length = 0
+    for piece in pieces:
+        pending.append(piece)
+        length += len(piece)
+        while length >= size:
+            joined = np.concatenate(pending) if len(pending) > 1 else pending[0]
+            yield joined[:size]
+            pending = [joined[size:]]
+            length -= size
+    if length:
+        yield np.concatenate(pending)
+
+def bitmap_pieces(bitmap, window):
+    '''The set bits of a bitmap as element arrays, window bytes at a time'''
+    for start in range(0, len(bitmap), window):
+        if np is None:
+            yield [(start + index) << 3 | bit
+                   for index, byte in enumerate(bitmap[start:start + window]) if byte
+                   for bit in range(8) if byte >> bit & 1]
+            continue
+        bits = np.unpackbits(np.frombuffer(bitmap[start:start + window], dtype=np.uint8),
+                             bitorder='little')
+        yield np.flatnonzero(bits).astype(np.uint64) + np.uint64(start << 3)
 
 class DynamicPerfectHashing:
-    def __init__(self, universe_size):
+    def __init__(self, universe_size, incremental=False, rehash_step=64, debug=False,
+                 executor=None, parallel_threshold=200000, stats=False,
+                 on_rehash_start=None, on_rehash_end=None, concurrent=False, background=False,
+                 storage='hashed', hash_family='carter-wegman', compact=False, shrink_below=None,
+                 journal=None, fsync='commit', group_commit=1024, on_escalation=None):
+        if universe_size >= 2 ** 64:
+            raise ValueError('Universe does not fit into 64-bit slots')
+        if storage not in STORAGE_MODES:
+            raise ValueError('Unknown storage {!r}'.format(storage))
+        if hash_family not in HASH_FAMILIES:
+            raise ValueError('Unknown hash family {!r}'.format(hash_family))
+
         self.count = 0
         self.table_list = []
-        self.entry = []
+        # slots of all subtables, plus the parameters of every subtable in
+        # flat arrays so the batch operations can hash without the objects
+        self.pool = SlotPool()
+        self.sub_table_k = array('Q')
+        self.sub_table_space = array('Q')
+        self.sub_table_offset = array('Q')
+        # running total of the subtable space (**) is checked against and the
+        # number of subtables, so the check doesn't have to visit every table
+        self.sub_table_space_total = 0
+        self.s = 0
+        # cross-check the running total with a full recount after every change
+        self.debug = debug
+        # a concurrent.futures executor, rebuilds of at least parallel_threshold
+        # elements build their subtables on it
+        self.executor = executor
+        self.parallel_threshold = parallel_threshold
         self.M = 0
+        # once deletes take count below shrink_below * M everything is
+        # rebuilt for the current count, None (the default) keeps the tables
+        # of the peak. A rebuild sets M to 1.5 * count, so with e.g. 0.25
+        # growing and shrinking again both take a number of writes
+        # proportional to count.
+        self.shrink_below = shrink_below
         # nice number
         self.c = 0.5
         self.universe_size = universe_size
         self.prime = self.calculate_prime(universe_size)
+        if self.prime >= 2 ** 64:
+            raise ValueError('Universe does not fit into 64-bit slots')
+        # the class of the top level and subtable hash functions, one of
+        # HASH_FAMILIES. Its table_size rounds the space of every table,
+        # (**) keeps counting the unrounded space.
+        self.hash_family = HASH_FAMILIES[hash_family]
+        # with compact the subtables get a quarter of the slots, see
+        # sub_table_slots. (**) and so the RehashAll rhythm stay those of
+        # the paper.
+        self.compact = compact
         # some bogus start value
-        self.universal_hash_function = HashFunction(self.prime, 0)
+        self.universal_hash_function = self.hash_family(self.prime, 0)
+        # with incremental set RehashAll is spread over the following writes,
+        # each of them advances the migration by rehash_step units of work
+        self.incremental = incremental
+        self.rehash_step = rehash_step
+        self.migration = None
+        # how many candidate functions the subtable builds needed, number of
+        # candidates -> number of builds
+        self.injective_attempts = Counter()
+        # searches that ran out of their retry budget, action -> number of
+        # times, see escalate. on_escalation(self, action) is called for
+        # every one of them.
+        self.escalations = Counter()
+        self.on_escalation = on_escalation
+        # rehash counters, None while disabled so the hot paths only pay for
+        # an is None check
+        self.stats = Stats() if stats else None
+        # called as on_rehash_start(self) and on_rehash_end(self, seconds)
+        # around every RehashAll, for incremental ones seconds is the time from
+        # the start of the migration to the swap
+        self.on_rehash_start = on_rehash_start
+        self.on_rehash_end = on_rehash_end
+        # with concurrent set lookups from other threads are safe while a
+        # thread writes: readers go through generation, which is replaced as a
+        # whole, and rebuilt subtables are copy-on-write. Writers are
+        # serialized by lock.
+        # with background set a RehashAll runs on a worker thread while the
+        # current tables keep taking lookups and writes, the writes are
+        # logged and replayed before the swap. It is an incremental RehashAll
+        # stepped by the worker instead of the writes and needs the
+        # copy-on-write subtables of concurrent mode.
+        self.background = background
+        self.worker = None
+        self.worker_error = None
+        if background:
+            incremental = concurrent = True
+            self.incremental = True
+        self.concurrent = concurrent
+        self.lock = threading.RLock() if concurrent else None
+        self.generation = None
+        self.publish()
+        # with storage 'bitmap' the elements are the set bits of a bitmap over
+        # the universe, no hashing at all. 'auto' starts out hashed and
+        # switches to the bitmap at a RehashAll, incremental ones included,
+        # once the bitmap is smaller than the projected hashed footprint.
+        # bitmap is None while hashed. 'auto' isn't the default: snapshots,
+        # freeze, checkpoints and payloads need the hashed storage, and a
+        # structure that works at one size would start failing at another.
+        self.storage = storage
+        self.bitmap = bytearray(universe_size // 8 + 1) if storage == 'bitmap' else None
+        # with a journal path every write is logged there, see Journal,
+        # checkpoint, recover, flush and close. It has to be new or empty, recover
+        # continues an existing one.
+        self.journal = None
+        if journal is not None:
+            if storage != 'hashed':
+                raise ValueError('Checkpoints of the journal need the hashed storage')
+            self.journal = Journal(journal, universe_size, fsync, group_commit, new=True)
 
     def calculate_prime(self, universe_size):
         '''Calculates prime larger than the universe_size'''
@@ -25,48 +554,97 @@ class DynamicPerfectHashing:
         elif universe_size == 1:
             return 2
 
-        primes = []
-        value = 3
-        is_prime = True
-        while True:
-            # check if it's divisible by prime
-            for prime in primes:
-                if value % prime == 0:
-                    is_prime = False
-                    break
-
-            # return if bigger than universe size
-            if value > universe_size and is_prime:
-                return value
-
-            # add to prime list because not divisible by prime
-            primes.append(value)
-            value += 2
-            is_prime = True
-
+        return next_prime(universe_size)
 
     def RehashAll(self, element):
         '''x is the new value that will be inserted'''
-        L = []
-
-        for table in self.table_list:
-            for entry in table.elements:
-                if not entry.deleted:
-                    L.append(entry.value)
-                    entry.deleted = True
-
-        L.append(element)
+        self.rehash_with([element])
+
+    def rehash_with(self, new_elements):
+        '''Rebuild everything from the stored elements plus new_elements'''
+        if self.on_rehash_start is not None:
+            self.on_rehash_start(self)
+        start = time.perf_counter()
+
+        L, payloads = self.live_contents(new_elements)
+        if np is not None:
+            if payloads is None:
+                L = np.unique(L)
+            else:
+                L, first = np.unique(L, return_index=True)
+                payloads = payloads[first]
+        elif payloads is None:
+            L = list(set(L))
+        else:
+            contents = {}
+            for element, item in zip(L, payloads):
+                contents.setdefault(element, item)
+            L, payloads = list(contents), list(contents.values())
+        self.build(L, payloads)
+
+        seconds = time.perf_counter() - start
+        if self.stats is not None:
+            self.stats.record_rehash(seconds)
+        if self.on_rehash_end is not None:
+            self.on_rehash_end(self, seconds)
+
+    def live_contents(self, new_elements):
+        '''The stored elements followed by new_elements and their payloads in the same order
+
+        A uint64 array with numpy and a list without, the payloads are None
+        unless the slots carry them.
+        '''
+        pool = self.pool
+        if np is not None:
+            slots = pool.live_slot_array(self.sub_table_offset, self.sub_table_space)
+            L = np.concatenate((np.frombuffer(pool.values, dtype=np.uint64)[slots],
+                                np.asarray(new_elements, dtype=np.uint64)))
+        else:
+            slots = [slot for table in self.table_list for slot in table.live_slots()]
+            L = [pool.values[slot] for slot in slots]
+            L.extend(new_elements)
+        return L, self.carried(slots, new_elements)
+
+    def carried(self, slots, new_elements):
+        '''Payloads of the elements in the slots followed by those of new_elements
+
+        Rebuilds take them along and hand them to stored once the elements
+        have their new slots. Without payloads this is None, see
+        PayloadHashing.
+        '''
+        return None
+
+    def stored(self, locations, items):
+        '''Write the payloads carried along into the slots at locations, see PayloadHashing'''
+        raise NotImplementedError('The slots carry no payloads')
+
+    def build(self, L, payloads=None):
+        '''Choose the top level function and build every subtable for the distinct elements L
+
+        payloads, if given, are parallel to L and go into the slots of their
+        elements.
+        '''
+        if self.storage == 'bitmap' or self.bitmap_is_smaller(len(L)):
+            self.build_bitmap(L)
+            return
 
         self.count = len(L)
         self.M = self.calculate_m(self.count)
 
-        s = max(1, 2 * (self.count - 1))
+        s = self.hash_family.table_size(max(1, 2 * (self.count - 1)))
+
+        if np is not None:
+            self.build_vectorized(np.asarray(L, dtype=np.uint64), s, payloads)
+            self.publish()
+            return
 
         W = [set() for _ in range(s)]
 
+        attempts = 0
         while True:
-            self.universal_hash_function = HashFunction(
-                self.prime, s)
+            if self.stats is not None:
+                self.stats.top_level_attempts += 1
+            self.universal_hash_function = self.hash_family(self.prime, s)
 
             for element in L:
                 W[self.universal_hash_function.hash(element)].add(element)
@@ -77,27 +655,560 @@ class DynamicPerfectHashing:
             if self.star_star_condition(sub_table_space_list, self.M):
                 break
 
+            attempts += 1
+            if attempts % TOP_LEVEL_BUDGET == 0:
+                s = self.escalate(attempts // TOP_LEVEL_BUDGET, s)
+
             # reset W
             W = [set() for _ in range(s)]
 
 
-        self.table_list = [Table(self.prime) for _ in range(s)]
+        self.pool = SlotPool()
+        self.table_list = [Table(self.prime, self.pool, index, family=self.hash_family)
+                           for index in range(s)]
         for index, table in enumerate(self.table_list):
             element_count = len(W[index])
-            table.update(element_count)
+            table.update(element_count, self.compact)
 
         for idx, table_set in enumerate(W):
             sub_table = self.table_list[idx]
-            while not self.is_injective(table_set, sub_table.hash_function):
-                sub_table.hash_function = HashFunction(self.prime, sub_table.allocated_space)
-
+            if table_set:
+                hash_function = self.find_injective(table_set, sub_table.allocated_space)
+                if hash_function.allocated_space != sub_table.allocated_space:
+                    sub_table.allocate(hash_function.allocated_space)
+                sub_table.hash_function = hash_function
+
+        self.sub_table_k = array('Q', [table.hash_function.k for table in self.table_list])
+        self.sub_table_space = array('Q', [table.allocated_space for table in self.table_list])
+        self.sub_table_offset = array('Q', [table.offset for table in self.table_list])
+        self.sub_table_space_total = sum(sub_table_space_list)
+        self.s = s
+
+        locations = []
         for element in L:
             j = self.universal_hash_function.hash(element)
             table = self.table_list[j]
             location = table.hash_function.hash(element)
-            table.elements[location].value = element
-            table.elements[location].deleted = False
+            table.store(location, element)
+            locations.append(table.offset + location)
+        if payloads is not None:
+            self.stored(locations, payloads)
+
+        self.publish()
+
+    def build_vectorized(self, keys, s, payloads=None):
+        '''build for a uint64 array, all subtables are searched and filled at once'''
+        # the (**) check only needs the bucket sizes
+        attempts = 0
+        while True:
+            if self.stats is not None:
+                self.stats.top_level_attempts += 1
+            hash_function = self.hash_family(self.prime, s)
+            j = hash_function.hash_many(keys).astype(np.intp)
+            bucket_sizes = np.bincount(j, minlength=s)
+
+            # calculate_required_space of every bucket
+            required_space = int((8 * bucket_sizes * bucket_sizes - 4 * bucket_sizes).sum())
+            if self.star_star_holds(required_space, s, self.M):
+                break
 
+            attempts += 1
+            if attempts % TOP_LEVEL_BUDGET == 0:
+                s = self.escalate(attempts // TOP_LEVEL_BUDGET, s)
+
+        # subtables of large rebuilds are built by worker processes
+        prime = hash_function.prime
+        order = np.argsort(j, kind='stable')
+        keys = keys[order]
+        if self.executor is not None and len(keys) >= self.parallel_threshold:
+            k, space, values, location, attempts = self.build_sub_tables_parallel(
+                keys, bucket_sizes, prime)
+        else:
+            k, space, values, location, attempts = build_sub_tables(
+                keys, bucket_sizes, prime, random.getrandbits(64), self.hash_family, self.compact)
+
+        self.injective_attempts.update(dict(zip(*(
+            counts.tolist() for counts in np.unique(attempts[bucket_sizes > 0], return_counts=True)))))
+
+        # same sizes as build_sub_tables, unless a subtable had to be enlarged
+        max_element_count = 2 * bucket_sizes
+        offset = np.cumsum(space) - space
+        enlarged = space != self.hash_family.table_sizes(
+            np.maximum(1, sub_table_slots(max_element_count, self.compact)))
+        for _ in range(int(enlarged.sum())):
+            self.report_escalation('enlarge_sub_table')
+
+        pool = SlotPool()
+        pool.values = array('Q', values.tobytes())
+        pool.occupied = bytearray((len(values) + 7) // 8)
+        occupied = np.frombuffer(pool.occupied, dtype=np.uint8)
+        np.bitwise_or.at(occupied, location >> 3, (1 << (location & 7)).astype(np.uint8))
+        del occupied
+
+        self.pool = pool
+        if payloads is not None:
+            self.stored(location, payloads[order])
+        self.universal_hash_function = hash_function
+        # millions of small objects in a row, keep the garbage collector from
+        # rescanning them over and over
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            self.table_list = [
+                Table(self.prime, pool, index, table_offset, table_space, element_count, table_max,
+                      self.hash_family(self.prime, table_space, table_k), self.hash_family)
+                for index, element_count, table_max, table_space, table_offset, table_k in zip(
+                    range(s), bucket_sizes.tolist(), max_element_count.tolist(), space.tolist(),
+                    offset.tolist(), k.tolist())]
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+        self.sub_table_k = array('Q', k.tobytes())
+        self.sub_table_space = array('Q', space.astype(np.uint64).tobytes())
+        self.sub_table_offset = array('Q', offset.astype(np.uint64).tobytes())
+        self.sub_table_space_total = required_space
+        self.s = s
+
+        if self.debug:
+            self.check_space_total()
+
+    def escalate(self, round, s):
+        '''The top level search ran out of its retry budget for the round-th time
+
+        Grows s first, then takes a larger prime, then the other hash family
+        and from then on doubles M, which makes (**) hold eventually for any
+        partition. Returns the new s.
+        '''
+        action = ESCALATIONS[min(round, len(ESCALATIONS)) - 1]
+        if action == 'larger_prime' and 2 * self.prime >= 2 ** 62:
+            action = 'grow_s'
+
+        if action == 'grow_s':
+            s = self.hash_family.table_size(2 * s)
+        elif action == 'larger_prime':
+            # small universes have only a few multipliers to draw from
+            self.prime = next_prime(max(2 * self.prime, 2 ** 31))
+        elif action == 'switch_family':
+            self.hash_family = next(family for family in HASH_FAMILIES.values()
+                                    if family is not self.hash_family)
+            s = self.hash_family.table_size(s)
+        else:
+            self.M *= 2
+
+        self.report_escalation(action)
+        return s
+
+    def report_escalation(self, action):
+        '''Count an escalation, in the structure a migration builds for'''
+        owner = self
+        if self.migration is not None and self.migration.target is self:
+            owner = self.migration.source
+        owner.escalations[action] += 1
+        if owner.on_escalation is not None:
+            owner.on_escalation(owner, action)
+
+    def bitmap_is_smaller(self, element_count):
+        '''True if storage 'auto' switches to the bitmap for element_count elements'''
+        return (self.storage == 'auto' and
+                self.universe_size // 8 + 1 <= HASHED_BYTES_PER_ELEMENT * element_count)
+
+    def build_bitmap(self, L):
+        '''Switch to the bitmap storage, holding the distinct elements L'''
+        bitmap = bytearray(self.universe_size // 8 + 1)
+        if np is not None:
+            byte_index, bit = key_bits(np.asarray(L, dtype=np.uint64))
+            np.bitwise_or.at(np.frombuffer(bitmap, dtype=np.uint8), byte_index, bit)
+        else:
+            for element in L:
+                bitmap[element >> 3] |= 1 << (element & 7)
+
+        self.count = len(L)
+        # concurrent readers look at bitmap first, it has to be complete
+        # before the tables go away
+        self.bitmap = bitmap
+        self.clear_tables()
+
+    def clear_tables(self):
+        '''Drop the hashed form, back to the state of an empty structure'''
+        self.table_list = []
+        self.pool = SlotPool()
+        self.sub_table_k = array('Q')
+        self.sub_table_space = array('Q')
+        self.sub_table_offset = array('Q')
+        self.sub_table_space_total = 0
+        self.s = 0
+        self.M = 0
+        self.universal_hash_function = self.hash_family(self.prime, 0)
+        self.publish()
+
+    def elements(self):
+        '''All stored elements, as a uint64 array with numpy and as a list without'''
+        if self.bitmap is not None:
+            if np is not None:
+                bits = np.unpackbits(np.frombuffer(self.bitmap, dtype=np.uint8), bitorder='little')
+                return np.flatnonzero(bits).astype(np.uint64)
+            return [index << 3 | bit for index, byte in enumerate(self.bitmap) if byte
+                    for bit in range(8) if byte >> bit & 1]
+
+        if np is not None:
+            return self.pool.live_array(self.sub_table_offset, self.sub_table_space)
+        return [element for table in self.table_list for element in table.live_values()]
+
+    def widen_universe(self, universe_size):
+        '''Grow the universe to universe_size, keeping the elements
+
+        The hash functions work modulo a prime above the universe, so the
+        hashed form is rebuilt for the new one. The bitmap storage moves to
+        the hashed form, with storage 'auto' a later RehashAll can switch back
+        if the bitmap of the wider universe still is the smaller one.
+        '''
+        self.finish_migration()
+        self.rebuild_universe(universe_size)
+
+    @serialized
+    def rebuild_universe(self, universe_size):
+        if universe_size < self.universe_size:
+            raise ValueError('Universe can only be widened')
+        prime = self.calculate_prime(universe_size)
+        if universe_size >= 2 ** 64 or prime >= 2 ** 64:
+            raise ValueError('Universe does not fit into 64-bit slots')
+
+        if self.bitmap is None:
+            L, payloads = self.live_contents(())
+        else:
+            L, payloads = self.elements(), None
+        self.universe_size = universe_size
+        if self.journal is not None:
+            self.journal.widen(universe_size)
+        self.prime = prime
+        if self.storage == 'bitmap':
+            self.storage = 'hashed'
+
+        if not len(L):
+            self.count = 0
+            self.bitmap = None
+            self.clear_tables()
+            return
+
+        # lookups keep going to the bitmap until the hashed form is complete
+        bitmap = self.bitmap
+        self.build(L, payloads)
+        if self.bitmap is bitmap:
+            self.bitmap = None
+
+    def publish(self):
+        '''Make the current tables the generation concurrent readers see'''
+        self.generation = Generation(self.universal_hash_function, self.table_list, self.pool,
+                                     self.sub_table_k, self.sub_table_space, self.sub_table_offset)
+
+    def build_sub_tables_parallel(self, keys, bucket_sizes, prime):
+        '''build_sub_tables on the executor, for groups of about PARALLEL_CHUNK keys'''
+        ends = np.cumsum(bucket_sizes)
+        starts = np.concatenate(([0], ends))
+        bounds = np.unique(np.concatenate((
+            [0], np.searchsorted(ends, np.arange(PARALLEL_CHUNK, len(keys), PARALLEL_CHUNK),
+                                 side='right'), [len(bucket_sizes)])))
+
+        futures = [
+            self.executor.submit(build_sub_tables, keys[starts[first]:starts[last]],
+                                 bucket_sizes[first:last], prime, random.getrandbits(64),
+                                 self.hash_family, self.compact)
+            for first, last in zip(bounds[:-1].tolist(), bounds[1:].tolist())]
+        results = [future.result() for future in futures]
+
+        # the groups are consecutive, their slots line up one after another
+        group_offset = np.cumsum([0] + [len(values) for _, _, values, _, _ in results])
+        return (np.concatenate([k for k, _, _, _, _ in results]),
+                np.concatenate([space for _, space, _, _, _ in results]),
+                np.concatenate([values for _, _, values, _, _ in results]),
+                np.concatenate([location + base for (_, _, _, location, _), base in zip(
+                    results, group_offset.tolist())]),
+                np.concatenate([attempts for _, _, _, _, attempts in results]))
+
+    @classmethod
+    def from_keys(cls, keys, universe_size, **options):
+        '''Build the structure for a known set of keys in one pass
+
+        Duplicates are dropped, M and s are sized once for the final count and
+        every subtable is built directly, instead of the chain of RehashAll
+        calls that N Inserts cause. The result takes the usual dynamic
+        operations afterwards, options go to the constructor.
+        '''
+        dynperf = cls(universe_size, **options)
+
+        if np is not None:
+            L = np.unique(dynperf.key_array(keys))
+        else:
+            L = set()
+            for element in keys:
+                if element < 0 or element > universe_size:
+                    raise ValueError('Element is outside of universe')
+                L.add(element)
+            L = list(L)
+
+        if len(L):
+            dynperf.build(L)
+        dynperf.journal_elements()
+
+        return dynperf
+
+    def journal_elements(self):
+        '''Log the elements a bulk constructor started out with as one batch insert
+
+        Without a snapshot the journal is all recover has, it has to hold
+        them too.
+        '''
+        if self.journal is None or not self.count:
+            return
+        elements = self.elements()
+        if np is None:
+            elements = array('Q', elements)
+        self.journal.append_many(JOURNAL_INSERT_MANY, elements)
+        self.journal.commit()
+
+    def snapshot(self):
+        '''Header and index, the sections and their offsets and the total size of a snapshot'''
+        if self.bitmap is not None:
+            raise NotImplementedError('Snapshots only hold the hashed storage')
+        if isinstance(self.table_list, SnapshotTables):
+            element_count, max_element_count = self.table_list.counts()
+        else:
+            element_count = array('Q', [table.element_count for table in self.table_list])
+            max_element_count = array('Q', [table.max_element_count for table in self.table_list])
+
+        sections = (self.sub_table_k, self.sub_table_space, self.sub_table_offset, element_count,
+                    max_element_count, self.pool.values, self.pool.occupied)
+        index = []
+        position = SNAPSHOT_HEADER.size + SNAPSHOT_INDEX.size
+        for section in sections:
+            position = (position + 7) & ~7
+            index += [position, memoryview(section).nbytes]
+            position += memoryview(section).nbytes
+
+        header = SNAPSHOT_HEADER.pack(
+            SNAPSHOT_MAGIC, SNAPSHOT_BYTE_ORDER_MARK, self.universe_size, self.prime,
+            self.universal_hash_function.k, self.s, self.count, self.M, self.sub_table_space_total,
+            len(self.pool.values), self.hash_family.name.encode()) + SNAPSHOT_INDEX.pack(*index)
+        return header, sections, index[::2], position
+
+    @serialized
+    def save(self, path):
+        '''Write a snapshot of the tables to path, see load'''
+        header, sections, offsets, _ = self.snapshot()
+        with open(path, 'wb') as snapshot:
+            snapshot.write(header)
+            for section, offset in zip(sections, offsets):
+                snapshot.write(bytes(offset - snapshot.tell()))
+                snapshot.write(section)
+
+    @serialized
+    def share(self, name=None):
+        '''Copy the tables into a new shared memory segment, returns the SharedMemory
+
+        Other processes attach to it by name with SharedPerfectHashing. The
+        segment is a snapshot, later writes don't show up in it. The caller
+        owns it: close and unlink it once the readers are done.
+        '''
+        header, sections, offsets, size = self.snapshot()
+        segment = shared_memory.SharedMemory(name, create=True, size=max(1, size))
+        segment.buf[:len(header)] = header
+        for section, offset in zip(sections, offsets):
+            section = memoryview(section).cast('B')
+            segment.buf[offset:offset + len(section)] = section
+        return segment
+
+    @serialized
+    def freeze(self):
+        '''Returns a FrozenPerfectHash of the stored elements, see thaw
+
+        The current hash functions are kept, the subtables are only moved
+        next to each other. A pending incremental RehashAll is left alone,
+        the old generation still has every element.
+        '''
+        if self.bitmap is not None:
+            raise NotImplementedError('Freezing needs the hashed storage')
+
+        empty = self.universe_size + 1
+        prime = self.universal_hash_function.prime
+        if not self.table_list:
+            # a single empty slot every lookup hashes to
+            return FrozenPerfectHash(self.universe_size, prime, self.hash_family, 1, 1, 0,
+                                     array('Q', (1, 1, 0)), array('Q', (empty,)))
+
+        if np is not None:
+            space = np.frombuffer(self.sub_table_space, dtype=np.uint64)
+            index = np.empty((self.s, 3), dtype=np.uint64)
+            index[:, 0] = np.frombuffer(self.sub_table_k, dtype=np.uint64)
+            index[:, 1] = space
+            index[:, 2] = np.cumsum(space) - space
+
+            values = np.full(int(space.sum()), empty, dtype=np.uint64)
+            keys = self.pool.live_array(self.sub_table_offset, self.sub_table_space)
+            j, location = self.locations(keys)
+            location += index[j, 2] - np.frombuffer(self.sub_table_offset, dtype=np.uint64)[j]
+            values[location.astype(np.intp)] = keys
+            index = array('Q', index.tobytes())
+            values = array('Q', values.tobytes())
+        else:
+            index = array('Q')
+            offset = 0
+            for k, space in zip(self.sub_table_k, self.sub_table_space):
+                index.extend((k, space, offset))
+                offset += space
+
+            values = array('Q', (empty,)) * offset
+            hash_one = self.hash_family.hash_one
+            for j, (k, space, old_offset) in enumerate(zip(
+                    self.sub_table_k, self.sub_table_space, self.sub_table_offset)):
+                for element in self.pool.live_values(old_offset, space):
+                    values[index[3 * j + 2] + hash_one(k, space, element, prime)] = element
+
+        return FrozenPerfectHash(self.universe_size, prime, self.hash_family,
+                                 self.universal_hash_function.k, self.s, self.count, index, values)
+
+    @serialized
+    def checkpoint(self, path):
+        '''Replace the snapshot at path atomically and start the journal over
+
+        The snapshot is written next to path, synced and renamed over it, only
+        then the journal is emptied. A crash in between leaves a journal
+        that recover applies a second time, which changes nothing. The
+        buffered records are committed first, the journal has to have every
+        write the snapshot has.
+        '''
+        if self.journal is not None:
+            self.journal.commit()
+        temporary = path + '.tmp'
+        self.save(temporary)
+        with open(temporary, 'rb') as snapshot:
+            os.fsync(snapshot.fileno())
+        os.replace(temporary, path)
+        directory = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+        if self.journal is not None:
+            self.journal.reset()
+
+    @serialized
+    def flush(self):
+        '''Write the journal records buffered for the next group commit'''
+        if self.journal is not None:
+            self.journal.commit()
+
+    @serialized
+    def close(self):
+        '''Flush and close the journal, later writes are no longer logged'''
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @classmethod
+    def recover(cls, snapshot_path, journal_path, fsync='commit', group_commit=1024,
+                **options):
+        '''Restore the state of a crashed process, writes keep going to the journal
+
+        Loads the snapshot checkpoint wrote last, if there is one, and applies
+        the journal on top of it. Only the last operation on every element
+        counts, so the journal is applied as one batch of deletes and one of
+        inserts with at most one RehashAll, no matter how many records it
+        has. An incomplete frame at the end is cut off. Options go to the
+        constructor.
+        '''
+        if options.get('storage', 'hashed') != 'hashed':
+            raise ValueError('Checkpoints of the journal need the hashed storage')
+        universe_size, elements, present, _ = read_journal(journal_path)
+        if os.path.exists(snapshot_path):
+            dynperf = cls.load(snapshot_path, **options)
+            # widened after the checkpoint
+            if universe_size is not None and universe_size > dynperf.universe_size:
+                dynperf.widen_universe(universe_size)
+        elif universe_size is not None:
+            dynperf = cls(universe_size, **options)
+        else:
+            raise ValueError('Neither a snapshot nor a journal to recover from')
+
+        if np is not None:
+            keys = np.frombuffer(elements, dtype=np.uint64)
+            # the last record of every element
+            unique, first = np.unique(keys[::-1], return_index=True)
+            inserted = np.frombuffer(present, dtype=np.uint8)[::-1][first] == 1
+            deleted = unique[~inserted]
+            deleted = deleted[dynperf.locate_many(deleted)]
+            inserted = unique[inserted]
+            inserted = inserted[~dynperf.locate_many(inserted)]
+        else:
+            last = dict(zip(elements, present))
+            deleted = [element for element, flag in last.items()
+                       if not flag and dynperf.Locate(element)]
+            inserted = [element for element, flag in last.items()
+                        if flag and not dynperf.Locate(element)]
+
+        dynperf.delete_many(deleted)
+        # a shrink may have started an incremental RehashAll
+        dynperf.finish_migration()
+        if dynperf.bitmap is None and dynperf.count + len(inserted) > dynperf.M:
+            # insert_many of incremental mode would go key by key
+            dynperf.rehash_with(inserted)
+        else:
+            dynperf.insert_many(inserted)
+
+        dynperf.journal = Journal(journal_path, dynperf.universe_size, fsync, group_commit)
+        return dynperf
+
+    @classmethod
+    def load(cls, path, mmap=True, **options):
+        '''Open a snapshot written by save, options go to the constructor
+
+        With mmap the file is mapped copy-on-write and the slots and subtable
+        arrays are views into the mapping, nothing is deserialized. Table
+        objects are only created for the subtables that get used, so the
+        structure is ready right away and processes loading the same file
+        share its page cache. Writes change the private copy of a page,
+        never the file. Without mmap the file is read into memory. A
+        hash_family option has to be the one of the snapshot.
+        '''
+        with open(path, 'rb') as snapshot:
+            if mmap:
+                buffer = memoryview(map_file(snapshot.fileno(), 0, access=ACCESS_COPY))
+            else:
+                buffer = memoryview(bytearray(snapshot.read()))
+
+        header, sections = read_snapshot(buffer)
+        universe_size, prime, k, s, count, M, sub_table_space_total, _, family = header
+
+        # the slots only work with the functions they were built with
+        if options.setdefault('hash_family', family.name) != family.name:
+            raise ValueError('Snapshot uses the hash family {!r}'.format(family.name))
+
+        dynperf = cls(universe_size, **options)
+        # larger than the one of the universe after an escalation
+        dynperf.prime = prime
+        dynperf.count = count
+        dynperf.M = M
+        dynperf.s = s
+        dynperf.sub_table_space_total = sub_table_space_total
+        dynperf.universal_hash_function = family(prime, s, k)
+        dynperf.pool = SlotPool()
+        dynperf.pool.values = sections['values']
+        dynperf.pool.occupied = sections['occupied']
+        dynperf.sub_table_k = sections['sub_table_k']
+        dynperf.sub_table_space = sections['sub_table_space']
+        dynperf.sub_table_offset = sections['sub_table_offset']
+        dynperf.table_list = SnapshotTables(dynperf, sections['element_count'],
+                                            sections['max_element_count'])
+        dynperf.publish()
+        dynperf.journal_elements()
+        return dynperf
 
     def calculate_required_space(self, elements):
         b = len(elements)
@@ -105,106 +1216,370 @@ class DynamicPerfectHashing:
         s = 2 * m * (m - 1)
         return s
 
+    @serialized
+    @journaled(JOURNAL_DELETE)
     def Delete(self, element):
-        '''Deletion of x simply flags x as deleted without removal and increments count.'''
+        '''Remove x by clearing the occupancy bit of its slot, decrements count'''
 
         if element < 0 or element > self.universe_size:
             raise ValueError('Element is outside of universe')
 
-        self.count -= 1
+        bitmap = self.bitmap
+        if bitmap is not None:
+            if not bitmap[element >> 3] >> (element & 7) & 1:
+                raise ValueError('Element does not exist')
+            bitmap[element >> 3] &= ~(1 << (element & 7))
+            self.count -= 1
+            return
+
+        self.delete_element(element)
+
+        if self.migration is not None:
+            self.migration.pending[element] = False
+            self.migration_step()
+
+        # also right after a migration completed, it was sized for an older count
+        if self.migration is None and self.should_shrink():
+            self.shrink()
+
+    def delete_element(self, element):
+        if not self.table_list:
+            raise ValueError('Element does not exist')
+
         j = self.universal_hash_function.hash(element)
 
         table = self.table_list[j]
 
         location = table.hash_function.hash(element)
 
-        if table.elements[location].deleted:
+        if not (table.is_occupied(location) and table.value(location) == element):
             raise ValueError('Element does not exist')
-        else:
-            table.elements[location].deleted = True
 
-        if self.count >= self.M:
-            self.RehashAll(-1)
+        table.remove(location)
+        self.count -= 1
+
+    def should_shrink(self):
+        '''True if count fell below shrink_below * M and a rebuild would lower M'''
+        return (self.shrink_below is not None and self.count < self.shrink_below * self.M
+                and self.calculate_m(self.count) < self.M)
+
+    def shrink(self):
+        '''RehashAll without new elements, sizes everything for the current count'''
+        if self.stats is not None:
+            self.stats.shrinks += 1
+        if self.incremental and self.table_list:
+            self.start_migration()
+        else:
+            self.rehash_with(())
 
+    @serialized
+    @journaled(JOURNAL_INSERT)
     def Insert(self, element):
         if element < 0 or element > self.universe_size:
             raise ValueError('Element is outside of universe')
 
-        self.count += 1
+        bitmap = self.bitmap
+        if bitmap is not None:
+            if not bitmap[element >> 3] >> (element & 7) & 1:
+                bitmap[element >> 3] |= 1 << (element & 7)
+                self.count += 1
+            return
 
-        if self.count > self.M:
-            self.RehashAll(element)
+        if self.migration is None:
+            self.insert_element(element)
         else:
-            j = self.universal_hash_function.hash(element)
+            self.migration.pending[element] = True
+            self.insert_element(element)
+            self.migration_step()
 
-            table = self.table_list[j]
-            location = table.hash_function.hash(element)
+    def insert_element(self, element):
+        self.count += 1
 
+        if self.count > self.M and self.migration is None:
+            if self.incremental and self.table_list:
+                # keep inserting into the current tables, the new generation
+                # is built by the following operations
+                self.start_migration()
+            else:
+                self.RehashAll(element)
+                return
 
+        j = self.universal_hash_function.hash(element)
 
-            # if a duplicate element is inserted, do nothing
-            if not table.elements[location].deleted and table.elements[location].value == element:
-                self.count -= 1
-                return
+        table = self.table_list[j]
+        location = table.hash_function.hash(element)
 
-            table.element_count += 1
-            # Is there enough space for the element
-            if table.element_count <= table.max_element_count:
-                if table.elements[location].deleted:
-                    table.elements[location].value = element
-                    table.elements[location].deleted = False
 
-                else:
-                    self.update_sub_table_same_size(table, element)
-            # We have to increase the size of the subtable
+
+        # if a duplicate element is inserted, do nothing
+        if table.is_occupied(location) and table.value(location) == element:
+            self.count -= 1
+            return
+
+        table.element_count += 1
+        # Is there enough space for the element
+        if table.element_count <= table.max_element_count:
+            if not table.is_occupied(location):
+                table.store(location, element)
+                if table.pool.payload is not None:
+                    self.stored((table.offset + location,), self.carried((), (element,)))
+
             else:
-                self.update_sub_table_increase_size(table, element)
+                self.update_sub_table_same_size(table, element)
+        # We have to increase the size of the subtable
+        else:
+            self.update_sub_table_increase_size(table, element)
+
+    def migration_target(self):
+        '''An empty structure the incremental RehashAll builds the new generation in'''
+        return DynamicPerfectHashing(self.universe_size, hash_family=self.hash_family.name,
+                                     compact=self.compact)
+
+    def start_migration(self):
+        '''Start an incremental RehashAll'''
+        if self.on_rehash_start is not None:
+            self.on_rehash_start(self)
+        if self.stats is not None:
+            self.stats.migrations += 1
+        self.migration = Migration(self)
+
+        if self.background:
+            self.worker = threading.Thread(target=self.run_migration, args=(self.migration,),
+                                           name='RehashAll', daemon=True)
+            self.worker.start()
+
+    def run_migration(self, migration):
+        '''Body of the background worker, builds the new generation and swaps it in'''
+        # the write that started the migration still has to store its element
+        with self.lock:
+            pass
+
+        error = None
+        try:
+            # the whole build and a first replay without the writer lock,
+            # readers and writers carry on meanwhile
+            migration.step(math.inf)
+        except BaseException as exception:
+            error = exception
+
+        with self.lock:
+            if error is None:
+                try:
+                    # only the writes that came in since are left
+                    migration.phase = migration.replay
+                    migration.step(math.inf)
+                    self.swap_migration()
+                except BaseException as exception:
+                    error = exception
+            if error is not None:
+                # the old generation is still complete, drop the new one
+                self.migration = None
+                self.worker_error = error
+            self.worker = None
+
+    def migration_step(self):
+        '''Advance the incremental RehashAll, swap in the new generation once it is done'''
+        # the worker takes care of it
+        if self.background:
+            return
+
+        if self.migration.step(self.rehash_step):
+            self.swap_migration()
+
+    def swap_migration(self):
+        '''Replace the tables with the completed new generation'''
+        migration = self.migration
+        if migration.bitmap is not None:
+            # storage 'auto' went for the bitmap, the count of the old
+            # generation is exact
+            self.migration = None
+            self.bitmap = migration.bitmap
+            self.clear_tables()
+            self.rehash_finished(migration)
+            return
+
+        target = migration.target
+        self.table_list = target.table_list
+        self.universal_hash_function = target.universal_hash_function
+        # an escalation of the new generation may have changed these
+        self.prime = target.prime
+        self.hash_family = target.hash_family
+        self.pool = target.pool
+        self.sub_table_k = target.sub_table_k
+        self.sub_table_space = target.sub_table_space
+        self.sub_table_offset = target.sub_table_offset
+        self.sub_table_space_total = target.sub_table_space_total
+        self.s = target.s
+        self.count = target.count
+        # the replayed writes may have grown the count past the M of the snapshot
+        self.M = max(target.M, self.calculate_m(self.count))
+        self.migration = None
+        self.publish()
+        self.rehash_finished(migration)
+
+        if self.debug:
+            self.check_space_total()
+
+    def rehash_finished(self, migration):
+        '''Report the completed incremental RehashAll to stats and on_rehash_end'''
+        seconds = time.perf_counter() - migration.start
+        if self.stats is not None:
+            self.stats.record_rehash(seconds)
+        if self.on_rehash_end is not None:
+            self.on_rehash_end(self, seconds)
+
+    def finish_migration(self):
+        '''Run a pending incremental RehashAll to completion
+
+        In background mode this waits for the worker and raises what it
+        failed with, if anything.
+        '''
+        if self.background:
+            worker = self.worker
+            if worker is not None:
+                worker.join()
+            error, self.worker_error = self.worker_error, None
+            if error is not None:
+                raise error
+            return
+
+        self.step_until_swapped()
+
+    @serialized
+    def step_until_swapped(self):
+        while self.migration is not None:
+            self.migration_step()
 
 
     def update_sub_table_same_size(self, table, new_element):
         '''Returns an injective hash function for the given table'''
-        sub_table_elements = list(map(lambda x: x.value, filter(
-            lambda element: not element.deleted, table.elements)))
-
-        for element in table.elements:
-            element.deleted = True
-
+        if self.stats is not None:
+            self.stats.same_size_rebuilds += 1
+        slots = table.live_slots()
+        values = self.pool.values
+        sub_table_elements = [values[slot] for slot in slots]
         sub_table_elements.append(new_element)
-        table.element_count = len(sub_table_elements)
 
-        hash_function = HashFunction(table.prime, table.allocated_space)
+        if self.concurrent:
+            return self.replace_sub_table(table, sub_table_elements, table.max_element_count,
+                                          table.allocated_space)
+        return self.rebuild_sub_table(table, sub_table_elements,
+                                      self.carried(slots, (new_element,)))
 
-        while not self.is_injective(sub_table_elements, hash_function):
-            hash_function = HashFunction(table.prime, table.allocated_space)
+    def rebuild_sub_table(self, table, sub_table_elements, payloads=None):
+        '''Rehash the given elements into the (emptied) table, payloads parallel to them'''
+        table.clear()
+        table.element_count = len(sub_table_elements)
 
+        hash_function = self.find_injective(sub_table_elements, table.allocated_space)
+        if hash_function.allocated_space != table.allocated_space:
+            table.allocate(hash_function.allocated_space)
         table.hash_function = hash_function
 
+        locations = []
         for element in sub_table_elements:
-            location = table.hash_function.hash(element)
-
-            table.elements[location].value = element
-            table.elements[location].deleted = False
+            location = hash_function.hash(element)
+            table.store(location, element)
+            locations.append(table.offset + location)
+        if payloads is not None:
+            self.stored(locations, payloads)
 
+        self.sub_table_k[table.index] = hash_function.k
+        self.sub_table_space[table.index] = table.allocated_space
+        self.sub_table_offset[table.index] = table.offset
 
         return hash_function
 
-    def update_sub_table_increase_size(self, table, new_element):
-        previous_allocated_space = table.allocated_space
+    def replace_sub_table(self, table, sub_table_elements, max_element_count, allocated_space):
+        '''rebuild_sub_table for concurrent mode, builds a new table in new slots
+
+        Readers that already got the old table finish their lookup in the old
+        slots, which stay as they are until the next RehashAll drops the
+        pool. The parameter arrays are updated between two increments of the
+        generation version, so batch lookups can tell they overlapped.
+        '''
+        new_table = Table(self.prime, self.pool, table.index,
+                          element_count=len(sub_table_elements), max_element_count=max_element_count,
+                          family=self.hash_family)
+        hash_function = self.find_injective(sub_table_elements, allocated_space)
+        new_table.allocate(hash_function.allocated_space)
+        new_table.hash_function = hash_function
 
-        table.max_element_count = 2 * max(1, table.max_element_count)
-        table.allocated_space = 2 * table.max_element_count * (table.max_element_count - 1)
+        for element in sub_table_elements:
+            new_table.store(hash_function.hash(element), element)
 
-        # add the amount of new elements
-        table.elements.extend([Entry() for _ in range(
-            table.allocated_space - previous_allocated_space)])
+        generation = self.generation
+        generation.version += 1
+        self.table_list[table.index] = new_table
+        self.sub_table_k[table.index] = hash_function.k
+        self.sub_table_space[table.index] = new_table.allocated_space
+        self.sub_table_offset[table.index] = new_table.offset
+        generation.version += 1
 
-        sub_table_space_list = [table.allocated_space for table in self.table_list]
+        return hash_function
 
-        if self.star_star_condition(sub_table_space_list, self.M):
-            self.update_sub_table_same_size(table, new_element)
+    def update_sub_table_increase_size(self, table, new_element):
+        if self.stats is not None:
+            self.stats.size_increases += 1
+        max_element_count = 2 * max(1, table.max_element_count)
+        required_space = 2 * max_element_count * (max_element_count - 1)
+        allocated_space = self.hash_family.table_size(
+            sub_table_slots(max_element_count, self.compact))
+
+        # check (**) with the grown table before touching its slots, RehashAll
+        # still has to find the old elements in there
+        space_total = self.sub_table_space_total - table.required_space() + required_space
+        holds = self.star_star_holds(space_total, self.s, self.M)
+
+        # while a new generation is built the old one may exceed the space bound
+        if self.incremental and self.migration is None and not holds:
+            self.start_migration()
+
+        if self.migration is not None or holds:
+            slots = table.live_slots()
+            values = self.pool.values
+            sub_table_elements = [values[slot] for slot in slots]
+            sub_table_elements.append(new_element)
+
+            self.sub_table_space_total = space_total
+            if self.concurrent:
+                self.replace_sub_table(table, sub_table_elements, max_element_count, allocated_space)
+            else:
+                payloads = self.carried(slots, (new_element,))
+                table.max_element_count = max_element_count
+                table.allocate(allocated_space)
+                self.rebuild_sub_table(table, sub_table_elements, payloads)
+
+            if self.debug:
+                self.check_space_total()
         else:
             self.RehashAll(new_element)
 
+    def statistics(self):
+        '''Snapshot of the counters and the current space usage, for export'''
+        snapshot = {
+            'storage': 'hashed' if self.bitmap is None else 'bitmap',
+            'bitmap_bytes': 0 if self.bitmap is None else len(self.bitmap),
+            'elements': self.count,
+            'M': self.M,
+            'sub_tables': self.s,
+            'sub_table_space': self.sub_table_space_total,
+            'allocated_slots': len(self.pool.values),
+            'injective_retries': sum((attempts - 1) * builds
+                                     for attempts, builds in self.injective_attempts.items()),
+            'escalations': dict(self.escalations),
+        }
+        if self.stats is not None:
+            snapshot.update(vars(self.stats))
+        return snapshot
+
+    def check_space_total(self):
+        '''Cross-check the running space total with a recount over all subtables'''
+        space_total = sum(table.required_space() for table in self.table_list)
+        if space_total != self.sub_table_space_total or len(self.table_list) != self.s:
+            raise RuntimeError('Subtable space total is {}, expected {}'.format(
+                self.sub_table_space_total, space_total))
+
     def is_injective(self, element_list, hash_function):
         '''Check if a hash on a list is injective'''
         location_list = set()
@@ -217,22 +1592,299 @@ class DynamicPerfectHashing:
 
         return True
 
+    def find_injective(self, elements, allocated_space):
+        '''Draw hash functions until one is injective on elements
+
+        Large buckets test a round of INJECTIVE_CANDIDATES functions with one
+        numpy computation. The number of candidates a search needed is
+        counted in injective_attempts. After INJECTIVE_BUDGET failed
+        candidates at one size the search moves on to twice the slots, the
+        allocated_space of the returned function is the one to allocate.
+        '''
+        if np is None or len(elements) < VECTORIZED_INJECTIVE_THRESHOLD:
+            attempts = 1
+            hash_function = self.hash_family(self.prime, allocated_space)
+            while not self.is_injective(elements, hash_function):
+                if attempts % INJECTIVE_BUDGET == 0:
+                    allocated_space = self.enlarge(allocated_space)
+                hash_function = self.hash_family(self.prime, allocated_space)
+                attempts += 1
+
+            self.injective_attempts[attempts] += 1
+            return hash_function
+
+        keys = np.fromiter(elements, dtype=np.uint64, count=len(elements))
+        attempts = 0
+        while True:
+            candidates = [self.hash_family.draw(self.prime) for _ in range(INJECTIVE_CANDIDATES)]
+            # one row of locations per candidate
+            locations = self.hash_family.hash_arrays(
+                np.array(candidates, dtype=np.uint64)[:, None], np.uint64(allocated_space), keys,
+                self.prime)
+            locations.sort(axis=1)
+            injective = ~(locations[:, 1:] == locations[:, :-1]).any(axis=1)
+
+            if injective.any():
+                first = int(injective.argmax())
+                self.injective_attempts[attempts + first + 1] += 1
+                return self.hash_family(self.prime, allocated_space, candidates[first])
+
+            attempts += len(candidates)
+            if attempts % INJECTIVE_BUDGET == 0:
+                allocated_space = self.enlarge(allocated_space)
+
+    def enlarge(self, allocated_space):
+        '''Subtable size to continue an injective search at that ran out of its budget'''
+        self.report_escalation('enlarge_sub_table')
+        return self.hash_family.table_size(2 * allocated_space)
+
     def Locate(self,element):
         '''Return true if the element exists'''
         if element < 0 or element > self.universe_size:
             raise ValueError('Element is outside of universe')
 
-        j = self.universal_hash_function.hash(element)
-        table = self.table_list[j]
-        location = table.hash_function.hash(element)
+        bitmap = self.bitmap
+        if bitmap is not None:
+            return bitmap[element >> 3] >> (element & 7) & 1 == 1
+
+        if self.concurrent:
+            # one read of generation, hash function and tables match
+            generation = self.generation
+            table_list = generation.table_list
+            # nothing was inserted yet
+            if not table_list:
+                return False
+            table = table_list[generation.hash_function.hash(element)]
+        else:
+            # nothing was inserted yet
+            if not self.table_list:
+                return False
 
-        prev_element = table.elements[location]
+            j = self.universal_hash_function.hash(element)
+            table = self.table_list[j]
+        location = table.offset + table.hash_function.hash(element)
 
-        if not table.elements[location].deleted and table.elements[location].value == element:
+        # inlined is_occupied, this is the hot path
+        pool = table.pool
+        if pool.occupied[location >> 3] >> (location & 7) & 1 and pool.values[location] == element:
             return True
 
         return False
 
+    def key_array(self, elements):
+        '''Returns the elements as a uint64 array, checks the universe bounds once'''
+        return key_array(elements, self.universe_size)
+
+    def locations(self, keys):
+        '''Vectorized two level hash, returns the subtable and the pool slot of every key'''
+        j = self.universal_hash_function.hash_many(keys)
+        k = np.frombuffer(self.sub_table_k, dtype=np.uint64)[j]
+        space = np.frombuffer(self.sub_table_space, dtype=np.uint64)[j]
+        offset = np.frombuffer(self.sub_table_offset, dtype=np.uint64)[j]
+
+        hash_function = self.universal_hash_function
+        return j, offset + hash_function.hash_arrays(k, space, keys, hash_function.prime)
+
+    def locate_keys(self, keys):
+        '''Locate for a checked key array'''
+        bitmap = self.bitmap
+        if bitmap is not None:
+            byte_index, bit = key_bits(keys)
+            return np.frombuffer(bitmap, dtype=np.uint8)[byte_index] & bit != 0
+
+        if not self.concurrent:
+            if not self.table_list or not len(keys):
+                return np.zeros(len(keys), dtype=bool)
+            return locate_slots(self.universal_hash_function, self.pool.values, self.pool.occupied,
+                                self.sub_table_k, self.sub_table_space, self.sub_table_offset, keys)
+
+        for _ in range(CONCURRENT_RETRIES):
+            generation = self.generation
+            version = generation.version
+            if not generation.table_list or not len(keys):
+                return np.zeros(len(keys), dtype=bool)
+            # an odd version means a subtable is being replaced
+            if version & 1 == 0:
+                pool = generation.pool
+                with pool.reading():
+                    found = locate_slots(
+                        generation.hash_function, pool.values, pool.occupied,
+                        generation.sub_table_k, generation.sub_table_space,
+                        generation.sub_table_offset, keys)
+                if generation.version == version:
+                    return found
+
+        return np.array([self.Locate(element) for element in keys.tolist()], dtype=bool)
+
+    def locate_many(self, elements):
+        '''Locate for a batch of elements, returns a boolean mask'''
+        if np is None:
+            return [self.Locate(element) for element in elements]
+
+        return self.locate_keys(self.key_array(elements))
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, element):
+        try:
+            return self.Locate(element)
+        except (TypeError, ValueError):
+            # not an element of the universe
+            return False
+
+    def __iter__(self):
+        '''The stored elements as ints, in no particular order, see iter_chunks'''
+        for chunk in self.iter_chunks():
+            yield from chunk.tolist()
+
+    def iter_chunks(self, size=65536):
+        '''Yield the stored elements in uint64 arrays of size, array('Q') without numpy
+
+        The subtables are scanned a window at a time and only occupied slots
+        of live regions count, so next to the structure only about one chunk
+        is held. Writes during the iteration may or may not show up in it.
+        '''
+        if size < 1:
+            raise ValueError('Chunk size has to be positive')
+
+        bitmap = self.bitmap
+        if bitmap is not None:
+            pieces = bitmap_pieces(bitmap, size)
+        else:
+            # in concurrent mode the generation holds still for a reader
+            generation = self.generation
+            pool = generation.pool
+            if np is None:
+                pieces = (pool.live_values(offset, space) for offset, space in zip(
+                    generation.sub_table_offset, generation.sub_table_space))
+            else:
+                pieces = pool.live_chunks(generation.sub_table_offset,
+                                          generation.sub_table_space, size)
+
+        return rechunk(pieces, size)
+
+    @serialized
+    def insert_many(self, elements):
+        '''Insert a batch of elements
+
+        Keys that land on a free slot of a subtable with room left are written
+        with one vectorized store, only the rest takes the Insert path. A
+        batch that pushes count past M triggers a single RehashAll for all of
+        its keys instead of one per key.
+        '''
+        if np is None:
+            for element in elements:
+                self.Insert(element)
+            return
+
+        keys = np.unique(self.key_array(elements))
+        keys = keys[~self.locate_keys(keys)]
+        if not len(keys):
+            return
+
+        if self.bitmap is not None:
+            byte_index, bit = key_bits(keys)
+            np.bitwise_or.at(np.frombuffer(self.bitmap, dtype=np.uint8), byte_index, bit)
+            self.count += len(keys)
+            if self.journal is not None:
+                self.journal.append_many(JOURNAL_INSERT_MANY, keys)
+            return
+
+        # every write has to be logged and has to advance the migration
+        if self.incremental and (self.migration is not None or self.count + len(keys) > self.M):
+            for element in keys.tolist():
+                self.Insert(element)
+            return
+
+        if self.count + len(keys) > self.M:
+            self.rehash_with(keys.tolist())
+            if self.journal is not None:
+                self.journal.append_many(JOURNAL_INSERT_MANY, keys)
+            return
+
+        j, location = self.locations(keys)
+        occupied = np.frombuffer(self.pool.occupied, dtype=np.uint8)
+        byte_index = location >> np.uint64(3)
+        bit = np.uint8(1) << (location & np.uint64(7)).astype(np.uint8)
+
+        # only the first key for every free slot can be stored directly
+        direct = np.zeros(len(keys), dtype=bool)
+        direct[np.unique(location, return_index=True)[1]] = True
+        direct &= (occupied[byte_index] & bit) == 0
+
+        # and only if its subtable stays within max_element_count
+        tables, added = np.unique(j[direct], return_counts=True)
+        for index, count in zip(tables.tolist(), added.tolist()):
+            table = self.table_list[index]
+            if table.element_count + count <= table.max_element_count:
+                table.element_count += count
+            else:
+                direct[direct & (j == index)] = False
+
+        values = np.frombuffer(self.pool.values, dtype=np.uint64)
+        values[location[direct]] = keys[direct]
+        np.bitwise_or.at(occupied, byte_index[direct], bit[direct])
+        if self.pool.payload is not None:
+            self.stored(location[direct], self.carried(np.empty(0, dtype=np.intp), keys[direct]))
+        self.count += int(direct.sum())
+        # the rest is logged by Insert
+        if self.journal is not None:
+            self.journal.append_many(JOURNAL_INSERT_MANY, keys[direct])
+
+        # the pool might grow below, release the buffers first
+        del occupied, values
+
+        for element in keys[~direct].tolist():
+            self.Insert(element)
+
+    @serialized
+    def delete_many(self, elements):
+        '''Delete a batch of elements, nothing is deleted if any of them does not exist'''
+        if np is None:
+            for element in elements:
+                self.Delete(element)
+            return
+
+        keys = self.key_array(elements)
+        if not len(keys):
+            return
+
+        if len(np.unique(keys)) != len(keys) or not self.locate_keys(keys).all():
+            raise ValueError('Element does not exist')
+        if self.journal is not None:
+            self.journal.append_many(JOURNAL_DELETE_MANY, keys)
+
+        if self.bitmap is not None:
+            byte_index, bit = key_bits(keys)
+            np.bitwise_and.at(np.frombuffer(self.bitmap, dtype=np.uint8), byte_index, ~bit)
+            self.count -= len(keys)
+            return
+
+        j, location = self.locations(keys)
+        occupied = np.frombuffer(self.pool.occupied, dtype=np.uint8)
+        bit = np.uint8(1) << (location & np.uint64(7)).astype(np.uint8)
+        np.bitwise_and.at(occupied, location >> np.uint64(3), ~bit)
+        if self.pool.payload is not None:
+            self.pool.release(location.tolist())
+
+        tables, removed = np.unique(j, return_counts=True)
+        for index, count in zip(tables.tolist(), removed.tolist()):
+            self.table_list[index].element_count -= count
+        self.count -= len(keys)
+
+        if self.migration is not None:
+            # log all of them first, the migration may complete on any step
+            for element in keys.tolist():
+                self.migration.pending[element] = False
+            for _ in range(len(keys)):
+                self.migration_step()
+                if self.migration is None:
+                    break
+
+        if self.migration is None and self.should_shrink():
+            self.shrink()
+
     def calculate_m(self, element_count):
         '''Calculate M'''
         M = math.ceil((1 + self.c) * max(element_count, 4))
@@ -240,59 +1892,1382 @@ class DynamicPerfectHashing:
 
     def star_star_condition(self, sub_table_space_list, M):
         '''Returns True if the condition holds'''
-        lhs = sum(sub_table_space_list)
+        return self.star_star_holds(sum(sub_table_space_list), len(sub_table_space_list), M)
+
+    def star_star_holds(self, total_space, s, M):
+        '''(**) for the summed up subtable space of s subtables'''
+        lhs = total_space
         rhs = (32 * (M ** 2) /
-               (len(sub_table_space_list) + 4 * M))
+               (s + 4 * M))
 
         return lhs <= rhs
 
-class Entry:
+class PayloadHashing(DynamicPerfectHashing):
+    '''DynamicPerfectHashing with an object per slot that moves along with its element
+
+    pool.payload is parallel to pool.values, a list or, with a typecode, an
+    array of that type. Whatever relocates elements takes their payloads
+    along in the same order (carried) and writes them into the new slots
+    (stored), no element is looked up again. Payloads of elements on their
+    way in are passed through incoming, element -> payload.
+    '''
+    def __init__(self, universe_size, typecode=None, **options):
+        if options.get('concurrent') or options.get('background'):
+            raise ValueError('Payloads do not support concurrent or background mode')
+        if options.get('storage', 'hashed') != 'hashed':
+            raise ValueError('Payloads need the hashed storage')
+        if options.get('journal') is not None:
+            raise ValueError('The journal only holds the elements')
+        super().__init__(universe_size, **options)
+        self.typecode = typecode
+        self.pool.payload = self.new_payload(0)
+        self.incoming = {}
+
+    def new_payload(self, allocated_space):
+        if self.typecode is None:
+            return [None] * allocated_space
+        return array(self.typecode, bytes(array(self.typecode).itemsize * allocated_space))
+
+    def slot(self, element):
+        '''Returns the pool slot of element, None if it is not stored'''
+        if not self.table_list:
+            return None
+
+        table = self.table_list[self.universal_hash_function.hash(element)]
+        location = table.offset + table.hash_function.hash(element)
+        pool = self.pool
+        if pool.occupied[location >> 3] >> (location & 7) & 1 and pool.values[location] == element:
+            return location
+        return None
+
+    def carried(self, slots, new_elements):
+        default = None if self.typecode is None else 0
+        if np is not None and isinstance(new_elements, np.ndarray):
+            new_elements = new_elements.tolist()
+        fresh = [self.incoming.get(element, default) for element in new_elements]
+
+        payload = self.pool.payload
+        if np is None or not isinstance(slots, np.ndarray):
+            return [payload[slot] for slot in slots] + fresh
+        if self.typecode is not None:
+            return np.concatenate((np.frombuffer(payload, dtype=self.typecode)[slots],
+                                   np.array(fresh, dtype=self.typecode)))
+        return np.fromiter(itertools.chain((payload[slot] for slot in slots.tolist()), fresh),
+                           dtype=object, count=len(slots) + len(fresh))
+
+    def stored(self, locations, items):
+        payload = self.pool.payload
+        if payload is None:
+            # a fresh pool of a RehashAll
+            payload = self.pool.payload = self.new_payload(len(self.pool.values))
+        if np is not None and isinstance(locations, np.ndarray):
+            if self.typecode is not None:
+                np.frombuffer(payload, dtype=self.typecode)[locations] = items
+                return
+            locations, items = locations.tolist(), items.tolist()
+        for location, item in zip(locations, items):
+            payload[location] = item
+
+    def build(self, L, payloads=None):
+        super().build(L, payloads)
+        if self.pool.payload is None:
+            self.pool.payload = self.new_payload(len(self.pool.values))
+
+    def clear_tables(self):
+        super().clear_tables()
+        self.pool.payload = self.new_payload(0)
+
+    def migration_target(self):
+        return PayloadHashing(self.universe_size, self.typecode,
+                              hash_family=self.hash_family.name, compact=self.compact)
+
+    def save(self, path):
+        raise NotImplementedError('Snapshots only hold the elements')
+
+    def share(self, name=None):
+        raise NotImplementedError('Snapshots only hold the elements')
+
+    def freeze(self):
+        raise NotImplementedError('Frozen tables only hold the elements')
+
+    @classmethod
+    def load(cls, path, mmap=True, **options):
+        raise NotImplementedError('Snapshots only hold the elements')
+
+    @classmethod
+    def recover(cls, snapshot_path, journal_path, **options):
+        raise NotImplementedError('Snapshots only hold the elements')
+
+
+class PerfectHashMap(PayloadHashing):
+    '''Mapping from the elements of the universe to values
+
+    The value of a key lives in the payload slot next to the key, a lookup
+    is the usual two hashes. With a typecode ('d', 'q', ...) the values are
+    kept in a typed array instead of a list of objects.
+    '''
+    def put(self, key, value):
+        location = self.slot(key)
+        if location is not None:
+            self.pool.payload[location] = value
+            if self.migration is not None:
+                # the new generation may have the old value, the replay copies it again
+                self.migration.pending[key] = True
+                self.migration_step()
+            return
+
+        self.incoming[key] = value
+        try:
+            super().Insert(key)
+        finally:
+            self.incoming = {}
+
+    def Insert(self, key):
+        raise NotImplementedError('A key needs a value, use put')
+
+    def insert_many(self, keys):
+        raise NotImplementedError('A key needs a value, use put')
+
+    def get(self, key, default=None):
+        location = self.slot(key)
+        if location is None:
+            return default
+        return self.pool.payload[location]
+
+    def pop(self, key, *default):
+        location = self.slot(key)
+        if location is None:
+            if default:
+                return default[0]
+            raise KeyError(key)
+
+        value = self.pool.payload[location]
+        self.Delete(key)
+        return value
+
+    def __getitem__(self, key):
+        location = self.slot(key)
+        if location is None:
+            raise KeyError(key)
+        return self.pool.payload[location]
+
+    def __setitem__(self, key, value):
+        self.put(key, value)
+
+
+class KeyedPerfectHashing:
+    '''Dynamic perfect hashing for str, bytes, int, float, tuple and None keys
+
+    Keys are mapped to 64-bit fingerprints, the fingerprints are the
+    elements of a PayloadHashing and the original key is the payload of the
+    slot. A lookup hashes the key once and compares it with the key in its
+    slot, so it stays O(1) in the worst case. Two keys with the same
+    fingerprint are practically impossible, the later one goes into
+    overflow instead of the slot.
+    '''
+    def __init__(self, **options):
+        self.table = PayloadHashing(FINGERPRINT_UNIVERSE, **options)
+        # key -> fingerprint for keys whose fingerprint slot holds another key
+        self.overflow = {}
+
+    @property
+    def count(self):
+        return self.table.count + len(self.overflow)
+
+    def Insert(self, key):
+        element = fingerprint(key)
+        table = self.table
+        location = table.slot(element)
+        if location is not None:
+            if table.pool.payload[location] != key:
+                self.overflow[key] = element
+            return
+
+        table.incoming[element] = key
+        try:
+            table.Insert(element)
+        finally:
+            table.incoming = {}
+
+    def Delete(self, key):
+        element = fingerprint(key)
+        table = self.table
+        location = table.slot(element)
+        if location is not None and table.pool.payload[location] == key:
+            table.Delete(element)
+            # a key that collided with this one takes over the slot
+            for other, other_element in self.overflow.items():
+                if other_element == element:
+                    del self.overflow[other]
+                    self.Insert(other)
+                    break
+        elif key in self.overflow:
+            del self.overflow[key]
+        else:
+            raise ValueError('Element does not exist')
+
+    def Locate(self, key):
+        '''Return true if the key exists'''
+        location = self.table.slot(fingerprint(key))
+        if location is not None and self.table.pool.payload[location] == key:
+            return True
+        return bool(self.overflow) and key in self.overflow
+
+    def insert_many(self, keys):
+        '''Insert a batch of keys, fingerprinted with fingerprint_many'''
+        keys = list(keys)
+        table = self.table
+        incoming = {}
+        elements = fingerprint_many(keys)
+        if np is not None:
+            elements = elements.tolist()
+        for key, element in zip(keys, elements):
+            other = incoming.setdefault(element, key)
+            if other != key:
+                self.overflow[key] = element
+
+        # fingerprints that are stored already go through Insert for the
+        # duplicate and collision handling
+        elements = list(incoming)
+        for element, stored in zip(elements, table.locate_many(elements)):
+            if stored:
+                self.Insert(incoming.pop(element))
+
+        table.incoming = incoming
+        try:
+            table.insert_many(list(incoming))
+        finally:
+            table.incoming = {}
+
+    def locate_many(self, keys):
+        '''Locate for a batch of keys, returns a list of booleans'''
+        keys = list(keys)
+        if np is None:
+            return [self.Locate(key) for key in keys]
+
+        table = self.table
+        elements = fingerprint_many(keys)
+        stored = table.locate_keys(elements)
+        found = [False] * len(keys)
+        if stored.any():
+            payload = table.pool.payload
+            _, locations = table.locations(elements[stored])
+            for index, location in zip(np.flatnonzero(stored).tolist(), locations.tolist()):
+                found[index] = payload[location] == keys[index]
+
+        if self.overflow:
+            found = [hit or key in self.overflow for hit, key in zip(found, keys)]
+        return found
+
+
+# odd 64-bit constant of the Fibonacci hash that picks the shard of a key
+SHARD_MULTIPLIER = 0x9E3779B97F4A7C15
+
+def shard_worker(connection, universe_size, options):
+    '''Serve one shard of a ShardedPerfectHashing until None arrives'''
+    dynperf = DynamicPerfectHashing(universe_size, **options)
+    while True:
+        request = connection.recv()
+        if request is None:
+            break
+
+        operation, arguments = request
+        try:
+            if operation == 'count':
+                result = dynperf.count
+            else:
+                result = getattr(dynperf, operation)(*arguments)
+        except Exception as error:
+            connection.send((False, error))
+        else:
+            connection.send((True, result))
+
+    connection.close()
+
+
+class ShardedPerfectHashing:
+    '''DynamicPerfectHashing split over worker processes
+
+    A multiplicative hash sends every key to one of shards independent
+    instances, each in its own process and reached through a pipe. Batches
+    are split by shard, sent to all shards at once and gathered, so the
+    shards work in parallel and a RehashAll only stalls the keys of its own
+    shard. options go to the DynamicPerfectHashing of every shard. Call
+    close, or use it as a context manager, to stop the processes.
+    '''
+    def __init__(self, universe_size, shards=None, context=None, **options):
+        if universe_size >= 2 ** 64:
+            raise ValueError('Universe does not fit into 64-bit slots')
+
+        self.universe_size = universe_size
+        self.shards = shards or os.cpu_count() or 1
+        context = context or multiprocessing.get_context()
+        self.connections = []
+        self.processes = []
+        for _ in range(self.shards):
+            connection, child_connection = context.Pipe()
+            process = context.Process(target=shard_worker, daemon=True,
+                                      args=(child_connection, universe_size, options))
+            process.start()
+            child_connection.close()
+            self.connections.append(connection)
+            self.processes.append(process)
+
+    def shard_of(self, element):
+        return ((element * SHARD_MULTIPLIER & 0xFFFFFFFFFFFFFFFF) >> 32) * self.shards >> 32
+
+    def split(self, elements):
+        '''Checks the elements, returns them and the positions of the elements of every shard'''
+        if np is None:
+            elements = list(elements)
+            for element in elements:
+                if element < 0 or element > self.universe_size:
+                    raise ValueError('Element is outside of universe')
+            positions = [[] for _ in range(self.shards)]
+            for position, element in enumerate(elements):
+                positions[self.shard_of(element)].append(position)
+            return elements, positions
+
+        keys = key_array(elements, self.universe_size)
+        shard = (keys * np.uint64(SHARD_MULTIPLIER) >> np.uint64(32)) * np.uint64(self.shards) >> np.uint64(32)
+        order = np.argsort(shard, kind='stable')
+        bounds = np.searchsorted(shard[order], np.arange(self.shards + 1))
+        return keys, [order[start:stop] for start, stop in zip(bounds[:-1], bounds[1:])]
+
+    def call(self, operation, elements):
+        '''Run operation on the elements of every shard, returns positions and results'''
+        elements, positions = self.split(elements)
+        requests = []
+        for shard, shard_positions in enumerate(positions):
+            if len(shard_positions):
+                if np is None:
+                    shard_elements = [elements[position] for position in shard_positions]
+                else:
+                    shard_elements = elements[shard_positions]
+                self.connections[shard].send((operation, (shard_elements,)))
+                requests.append((shard, shard_positions))
+
+        return list(zip((shard_positions for _, shard_positions in requests),
+                        self.receive(shard for shard, _ in requests)))
+
+    def receive(self, shards):
+        '''Collect the replies of the shards, raises the first error after reading all of them'''
+        replies = [self.connections[shard].recv() for shard in shards]
+        for success, result in replies:
+            if not success:
+                raise result
+        return [result for _, result in replies]
+
+    def insert_many(self, elements):
+        self.call('insert_many', elements)
+
+    def locate_many(self, elements):
+        '''Locate for a batch of elements, returns a boolean mask'''
+        results = self.call('locate_many', elements)
+        if np is None:
+            found = [False] * sum(len(positions) for positions, _ in results)
+            for positions, shard_found in results:
+                for position, hit in zip(positions, shard_found):
+                    found[position] = hit
+            return found
+
+        found = np.zeros(sum(len(positions) for positions, _ in results), dtype=bool)
+        for positions, shard_found in results:
+            found[positions] = shard_found
+        return found
+
+    def delete_many(self, elements):
+        '''Delete a batch of elements, nothing is deleted if any of them does not exist'''
+        elements = list(elements)
+        if len(set(elements)) != len(elements) or not all(self.locate_many(elements)):
+            raise ValueError('Element does not exist')
+        self.call('delete_many', elements)
+
+    def Insert(self, element):
+        self.insert_many([element])
+
+    def Delete(self, element):
+        self.delete_many([element])
+
+    def Locate(self, element):
+        '''Return true if the element exists'''
+        return bool(self.locate_many([element])[0])
+
+    @property
+    def count(self):
+        for connection in self.connections:
+            connection.send(('count', ()))
+        return sum(self.receive(range(self.shards)))
+
+    def close(self):
+        '''Stop the shard processes'''
+        for connection in self.connections:
+            connection.send(None)
+            connection.close()
+        for process in self.processes:
+            process.join()
+        self.connections = []
+        self.processes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class SharedPerfectHashing:
+    '''Read-only attachment to a table that DynamicPerfectHashing.share put into shared memory
+
+    Locate and locate_many hash straight into the shared segment, nothing
+    is copied and no Table objects are created, so attaching is instant and
+    every process uses the same physical memory. Call close, or use it as a
+    context manager, to detach.
+    '''
+    def __init__(self, name):
+        self.segment, buffer = self.attach(name)
+        header, sections = read_snapshot(buffer)
+        self.universe_size, prime, k, self.s, self.count, _, _, _, self.family = header
+        self.hash_function = self.family(prime, self.s, k)
+        self.prime = self.hash_function.prime
+        self.sub_table_k = sections['sub_table_k']
+        self.sub_table_space = sections['sub_table_space']
+        self.sub_table_offset = sections['sub_table_offset']
+        self.values = sections['values']
+        self.occupied = sections['occupied']
+        self.sections = list(sections.values())
+
+    @staticmethod
+    def attach(name):
+        '''Open the segment without registering it, returns it and its buffer
+
+        Before Python 3.13 attaching registers the segment with the resource
+        tracker, which unlinks it when the process exits or, if the process
+        shares the tracker with the creator, drops the registration of the
+        creator. Where the segments are files in /dev/shm they are mapped
+        read-only directly instead.
+        '''
+        try:
+            segment = shared_memory.SharedMemory(name, track=False)
+            return segment, segment.buf
+        except TypeError:
+            pass
+
+        path = os.path.join('/dev/shm', name.lstrip('/'))
+        if os.path.isdir('/dev/shm'):
+            with open(path, 'rb') as segment_file:
+                segment = map_file(segment_file.fileno(), 0, access=ACCESS_READ)
+            return segment, memoryview(segment)
+
+        segment = shared_memory.SharedMemory(name)
+        resource_tracker.unregister(segment._name, 'shared_memory')
+        return segment, segment.buf
+
+    def Locate(self, element):
+        '''Return true if the element exists'''
+        if element < 0 or element > self.universe_size:
+            raise ValueError('Element is outside of universe')
+        if not self.s:
+            return False
+
+        j = self.hash_function.hash(element)
+        location = self.sub_table_offset[j] + self.family(
+            self.prime, self.sub_table_space[j], self.sub_table_k[j]).hash(element)
+        return bool(self.occupied[location >> 3] >> (location & 7) & 1
+                    and self.values[location] == element)
+
+    def locate_many(self, elements):
+        '''Locate for a batch of elements, returns a boolean mask'''
+        if np is None:
+            return [self.Locate(element) for element in elements]
+
+        keys = key_array(elements, self.universe_size)
+        if not self.s or not len(keys):
+            return np.zeros(len(keys), dtype=bool)
+        return locate_slots(self.hash_function, self.values, self.occupied, self.sub_table_k,
+                            self.sub_table_space, self.sub_table_offset, keys)
+
+    def close(self):
+        '''Detach from the segment'''
+        for section in self.sections:
+            section.release()
+        self.sections = []
+        self.segment.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class FrozenPerfectHash:
+    '''Read-only set of elements in one flat slot array, see DynamicPerfectHashing.freeze
+
+    index holds k, allocated space and offset of every subtable one after
+    another and the subtables lie back to back in values, without the
+    regions that growth left behind in the pool. Empty slots hold
+    universe_size + 1, which no element equals, so a lookup is two hashes
+    and one comparison without occupancy bits or Table objects. save and
+    load write and map the arrays as they are, thaw returns a dynamic
+    structure for the same elements.
+    '''
+    def __init__(self, universe_size, prime, family, k, s, count, index, values):
+        self.universe_size = universe_size
+        self.prime = prime
+        self.family = family
+        self.hash_function = family(prime, s, k)
+        self.s = s
+        self.count = count
+        self.index = index
+        self.values = values
+
+    def Locate(self, element):
+        '''Return true if the element exists'''
+        if element < 0 or element > self.universe_size:
+            raise ValueError('Element is outside of universe')
+
+        index = self.index
+        j = 3 * self.hash_function.hash(element)
+        location = index[j + 2] + self.family.hash_one(index[j], index[j + 1], element, self.prime)
+        return self.values[location] == element
+
+    def locate_many(self, elements):
+        '''Locate for a batch of elements, returns a boolean mask'''
+        if np is None:
+            return [self.Locate(element) for element in elements]
+
+        keys = key_array(elements, self.universe_size)
+        index = np.frombuffer(self.index, dtype=np.uint64).reshape(-1, 3)[
+            self.hash_function.hash_many(keys)]
+        location = index[:, 2] + self.family.hash_arrays(index[:, 0], index[:, 1], keys, self.prime)
+        return np.frombuffer(self.values, dtype=np.uint64)[location.astype(np.intp)] == keys
+
+    def elements(self):
+        '''All elements, as a uint64 array with numpy and as a list without'''
+        empty = self.universe_size + 1
+        if np is not None:
+            values = np.frombuffer(self.values, dtype=np.uint64)
+            return values[values != empty]
+        return [value for value in self.values if value != empty]
+
+    def thaw(self, **options):
+        '''A DynamicPerfectHashing with the same elements, options go to its constructor'''
+        options.setdefault('hash_family', self.family.name)
+        return DynamicPerfectHashing.from_keys(self.elements(), self.universe_size, **options)
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, element):
+        try:
+            return self.Locate(element)
+        except (TypeError, ValueError):
+            # not an element of the universe
+            return False
+
+    def __iter__(self):
+        '''The elements as ints, in no particular order'''
+        elements = self.elements()
+        return iter(elements.tolist() if np is not None else elements)
+
+    def header(self):
+        return FROZEN_HEADER.pack(
+            FROZEN_MAGIC, SNAPSHOT_BYTE_ORDER_MARK, self.universe_size, self.prime,
+            self.hash_function.k, self.s, self.count, len(self.values), self.family.name.encode())
+
+    def to_bytes(self):
+        '''The serialized form, see from_buffer'''
+        return self.header() + self.index.tobytes() + self.values.tobytes()
+
+    @classmethod
+    def from_buffer(cls, buffer):
+        '''Reads to_bytes output, the arrays are views of buffer'''
+        buffer = memoryview(buffer)
+        if len(buffer) < FROZEN_HEADER.size:
+            raise ValueError('Not a frozen table')
+        (magic, byte_order_mark, universe_size, prime, k, s, count, slots,
+         family) = FROZEN_HEADER.unpack_from(buffer)
+        if magic != FROZEN_MAGIC:
+            raise ValueError('Not a frozen table')
+        if byte_order_mark != SNAPSHOT_BYTE_ORDER_MARK:
+            raise ValueError('Frozen table was written with a different byte order')
+        family = family.rstrip(b'\0').decode()
+        if family not in HASH_FAMILIES:
+            raise ValueError('Frozen table uses the unknown hash family {!r}'.format(family))
+
+        start = FROZEN_HEADER.size
+        index = buffer[start:start + 24 * s].cast('Q')
+        values = buffer[start + 24 * s:start + 24 * s + 8 * slots].cast('Q')
+        if len(values) != slots:
+            raise ValueError('Frozen table is truncated')
+        return cls(universe_size, prime, HASH_FAMILIES[family], k, s, count, index, values)
+
+    def save(self, path):
+        '''Write the table to path, see load'''
+        with open(path, 'wb') as frozen:
+            frozen.write(self.header())
+            frozen.write(self.index)
+            frozen.write(self.values)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        '''Read a table written by save, with mmap the arrays are a read-only mapping of the file'''
+        with open(path, 'rb') as frozen:
+            if mmap:
+                return cls.from_buffer(map_file(frozen.fileno(), 0, access=ACCESS_READ))
+            return cls.from_buffer(frozen.read())
+
+    def __reduce__(self):
+        return FrozenPerfectHash.from_buffer, (self.to_bytes(),)
+
+
+class Generation:
+    '''What a concurrent reader needs for a lookup, replaced as a whole by RehashAll
+
+    version is odd while a subtable of the generation is being replaced.
+    '''
+    __slots__ = ('hash_function', 'table_list', 'pool', 'sub_table_k', 'sub_table_space',
+                 'sub_table_offset', 'version')
+
+    def __init__(self, hash_function, table_list, pool, sub_table_k, sub_table_space,
+                 sub_table_offset):
+        self.hash_function = hash_function
+        self.table_list = table_list
+        self.pool = pool
+        self.sub_table_k = sub_table_k
+        self.sub_table_space = sub_table_space
+        self.sub_table_offset = sub_table_offset
+        self.version = 0
+
+
+class Stats:
+    '''Counters for the rehash activity of a DynamicPerfectHashing'''
     def __init__(self):
-        self.value = None
-        self.deleted = True
-    
+        # full RehashAll runs, incremental ones included
+        self.rehashes = 0
+        self.rehash_seconds = 0.0
+        self.max_rehash_seconds = 0.0
+        self.last_rehash_seconds = 0.0
+        # incremental RehashAll runs started
+        self.migrations = 0
+        # top level functions drawn until (**) held
+        self.top_level_attempts = 0
+        self.same_size_rebuilds = 0
+        self.size_increases = 0
+        # RehashAll runs started because count fell below shrink_below * M
+        self.shrinks = 0
+
+    def record_rehash(self, seconds):
+        self.rehashes += 1
+        self.rehash_seconds += seconds
+        self.max_rehash_seconds = max(self.max_rehash_seconds, seconds)
+        self.last_rehash_seconds = seconds
+
     def __repr__(self):
-        return (str(self.value), str(self.deleted))
+        return 'Stats({})'.format(', '.join('{}={}'.format(*item) for item in vars(self).items()))
+
+
+class Journal:
+    '''Append-only log of the writes to a DynamicPerfectHashing
+
+    Records are buffered and written as one frame per group commit, once
+    group_commit elements are buffered or when commit is called. fsync
+    'commit' syncs the file at every group commit, 'always' commits and
+    syncs every write before it returns and 'never' leaves it to the
+    operating system. A crash loses at most the buffered records. Opening
+    an existing journal cuts off an incomplete frame at its end, with new
+    set it has to be empty.
+    '''
+    def __init__(self, path, universe_size, fsync='commit', group_commit=1024, new=False):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError('Unknown fsync policy {!r}'.format(fsync))
+        journal_universe_size, elements, _, length = read_journal(path)
+        if new and elements:
+            raise ValueError('Journal has records, recover from it instead')
+        if journal_universe_size not in (None, universe_size):
+            raise ValueError('Journal is for a different universe')
+
+        self.path = path
+        self.universe_size = universe_size
+        self.fsync = fsync
+        self.group_commit = 1 if fsync == 'always' else group_commit
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        os.ftruncate(self.fd, length)
+        if not length:
+            self.write(JOURNAL_HEADER.pack(JOURNAL_MAGIC, SNAPSHOT_BYTE_ORDER_MARK, universe_size))
+        self.buffer = bytearray()
+        self.buffered = 0
+
+    def append(self, operation, element):
+        self.buffer += JOURNAL_RECORD.pack(operation, element)
+        self.buffered += 1
+        if self.buffered >= self.group_commit:
+            self.commit()
+
+    def append_many(self, operation, keys):
+        '''Record a batch operation, keys is a uint64 array'''
+        for start in range(0, len(keys), JOURNAL_BATCH):
+            batch = keys[start:start + JOURNAL_BATCH]
+            self.buffer += JOURNAL_RECORD.pack(operation, len(batch))
+            self.buffer += batch.tobytes()
+            self.buffered += len(batch)
+            if self.buffered >= self.group_commit:
+                self.commit()
+
+    def commit(self):
+        '''Write the buffered records as a frame'''
+        if not self.buffer:
+            return
+        self.write(JOURNAL_FRAME.pack(len(self.buffer), zlib.crc32(self.buffer)) + self.buffer)
+        self.buffer = bytearray()
+        self.buffered = 0
+
+    def write(self, data):
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self.fd, view):]
+        if self.fsync != 'never':
+            os.fsync(self.fd)
+
+    def widen(self, universe_size):
+        '''Record that the universe grew, later records may be beyond the old one'''
+        self.universe_size = universe_size
+        self.append(JOURNAL_WIDEN, universe_size)
+
+    def reset(self):
+        '''Drop every record, after a checkpoint
+
+        The header is written again with the current universe, the one of the
+        snapshot. An empty file left by a crash in between is a journal
+        without records.
+        '''
+        self.buffer = bytearray()
+        self.buffered = 0
+        os.ftruncate(self.fd, 0)
+        self.write(JOURNAL_HEADER.pack(JOURNAL_MAGIC, SNAPSHOT_BYTE_ORDER_MARK, self.universe_size))
+        os.fsync(self.fd)
+
+    def close(self):
+        self.commit()
+        os.close(self.fd)
+
+
+class Migration:
+    '''State of an incremental RehashAll
+
+    The new generation is built into target from a snapshot of the stored
+    elements, in steps of a bounded amount of work: collect the elements
+    table by table, hash them into buckets until (**) holds, build the
+    subtables bucket by bucket and finally replay the writes logged in
+    pending meanwhile. Until then the old generation stays complete, it
+    takes every write, so lookups never have to look at the new one.
+    Payloads are collected along with their elements into items and go
+    into the new slots with them. If storage 'auto' finds the bitmap to be
+    the smaller form for the collected elements, they are filled into
+    bitmap instead and the replay goes there too.
+    '''
+    def __init__(self, dynperf):
+        self.source = dynperf
+        self.target = dynperf.migration_target()
+        # the target is under construction, replayed writes must not start a
+        # RehashAll of their own
+        self.target.migration = self
+        self.target.injective_attempts = dynperf.injective_attempts
+        self.pending = {}
+        self.start = time.perf_counter()
+        self.phase = self.collect
+        self.position = 0
+        self.elements = []
+        # parallel to elements if the slots carry payloads
+        self.items = None if dynperf.pool.payload is None else []
+        self.bitmap = None
+        # allocated_space of a subtable by element count, see table_slots
+        self.table_sizes = []
+
+    def step(self, budget):
+        '''Do about budget units of work, returns True once target is complete'''
+        while budget > 0:
+            budget = self.phase(budget)
+            if self.phase is None:
+                return True
+        return False
+
+    def collect(self, budget):
+        tables = self.source.table_list
+        while budget > 0 and self.position < len(tables):
+            table = tables[self.position]
+            if self.items is None:
+                self.elements.extend(table.live_values())
+            else:
+                slots = table.live_slots()
+                if slots:
+                    values = table.pool.values
+                    self.elements.extend(values[slot] for slot in slots)
+                    self.items.extend(self.source.carried(slots, ()))
+            budget -= max(1, table.allocated_space)
+            self.position += 1
+
+        if self.position == len(tables) and self.source.bitmap_is_smaller(len(self.elements)):
+            self.bitmap = bytearray(self.source.universe_size // 8 + 1)
+            self.position = 0
+            self.phase = self.fill
+        elif self.position == len(tables):
+            target = self.target
+            target.count = len(self.elements)
+            target.M = target.calculate_m(target.count)
+            self.s = target.hash_family.table_size(max(1, 2 * (target.count - 1)))
+            self.attempts = 0
+            self.start_partition()
+
+        return budget
+
+    def table_slots(self, element_count):
+        '''allocated_space Table.update gives a subtable of element_count elements'''
+        # buckets stay small, the sizes are remembered by element count
+        sizes = self.table_sizes
+        while len(sizes) <= element_count:
+            sizes.append(self.target.hash_family.table_size(
+                max(1, sub_table_slots(2 * len(sizes), self.target.compact))))
+        return sizes[element_count]
+
+    def fill(self, budget):
+        elements = self.elements
+        bitmap = self.bitmap
+        while budget > 0 and self.position < len(elements):
+            element = elements[self.position]
+            bitmap[element >> 3] |= 1 << (element & 7)
+            budget -= 1
+            self.position += 1
+
+        if self.position == len(elements):
+            self.elements = None
+            self.phase = self.replay
+
+        return budget
+
+    def start_partition(self):
+        if self.source.stats is not None:
+            self.source.stats.top_level_attempts += 1
+        self.hash_function = self.target.hash_family(self.target.prime, self.s)
+        # only non-empty buckets are materialized
+        self.buckets = {}
+        self.bucket_items = {}
+        self.required_space = 0
+        # slots the subtables of the buckets take, so the pool can be
+        # allocated at once and no build step has to grow it
+        self.slots = self.s * self.table_slots(0)
+        self.position = 0
+        self.phase = self.partition
+
+    def partition(self, budget):
+        elements = self.elements
+        items = self.items
+        while budget > 0 and self.position < len(elements):
+            element = elements[self.position]
+            j = self.hash_function.hash(element)
+            bucket = self.buckets.setdefault(j, [])
+            # calculate_required_space grows by this much per element
+            self.required_space += 16 * len(bucket) + 4
+            self.slots += self.table_slots(len(bucket) + 1) - self.table_slots(len(bucket))
+            bucket.append(element)
+            if items is not None:
+                self.bucket_items.setdefault(j, []).append(items[self.position])
+            budget -= 1
+            self.position += 1
+
+        if self.position == len(elements):
+            if self.target.star_star_holds(self.required_space, self.s, self.target.M):
+                target = self.target
+                target.universal_hash_function = self.hash_function
+                target.sub_table_space_total = self.required_space
+                target.s = self.s
+                target.pool = SlotPool()
+                if self.items is not None:
+                    target.pool.payload = target.new_payload(0)
+                # and some room for the tables the replay grows
+                target.pool.reserve(self.slots + self.slots // MIGRATION_HEADROOM)
+                # the per-table arrays are sized here too, build fills them in
+                target.table_list = [None] * self.s
+                target.sub_table_k = array('Q', bytes(8 * self.s))
+                target.sub_table_space = array('Q', bytes(8 * self.s))
+                target.sub_table_offset = array('Q', bytes(8 * self.s))
+                self.position = 0
+                self.phase = self.build
+            else:
+                self.attempts += 1
+                if self.attempts % TOP_LEVEL_BUDGET == 0:
+                    self.s = self.target.escalate(self.attempts // TOP_LEVEL_BUDGET, self.s)
+                self.start_partition()
+
+        return budget
+
+    def build(self, budget):
+        target = self.target
+        while budget > 0 and self.position < self.s:
+            bucket = self.buckets.get(self.position, ())
+            table = Table(target.prime, target.pool, self.position, family=target.hash_family)
+            table.update(len(bucket), target.compact)
+            if bucket:
+                hash_function = target.find_injective(bucket, table.allocated_space)
+                if hash_function.allocated_space != table.allocated_space:
+                    table.allocate(hash_function.allocated_space)
+                table.hash_function = hash_function
+
+            if self.items is None:
+                for element in bucket:
+                    table.store(table.hash_function.hash(element), element)
+            elif bucket:
+                locations = []
+                for element in bucket:
+                    location = table.hash_function.hash(element)
+                    table.store(location, element)
+                    locations.append(table.offset + location)
+                target.stored(locations, self.bucket_items[self.position])
+
+            target.table_list[self.position] = table
+            target.sub_table_k[self.position] = table.hash_function.k
+            target.sub_table_space[self.position] = table.allocated_space
+            target.sub_table_offset[self.position] = table.offset
+            budget -= len(bucket) + 1
+            self.position += 1
+
+        if self.position == self.s:
+            self.buckets = None
+            self.elements = None
+            self.bucket_items = None
+            self.items = None
+            self.phase = self.replay
+
+        return budget
+
+    def replay(self, budget):
+        target = self.target
+        pending = self.pending
+        bitmap = self.bitmap
+        while budget > 0 and pending:
+            element, present = pending.popitem()
+            if bitmap is not None:
+                if present:
+                    bitmap[element >> 3] |= 1 << (element & 7)
+                else:
+                    bitmap[element >> 3] &= ~(1 << (element & 7))
+            elif present and not target.Locate(element):
+                target.insert_element(element)
+            elif not present and target.Locate(element):
+                target.delete_element(element)
+            if present and target.pool.payload is not None:
+                # the payload may have changed after it was collected
+                source = self.source
+                target.stored((target.slot(element),),
+                              source.carried((source.slot(element),), ()))
+            budget -= 1
+
+        if not pending:
+            self.phase = None
+
+        return budget
+
 
 class HashFunction:
-    def __init__(self, prime, allocated_space):
+    '''(k * element mod prime) mod allocated_space, the family of the paper
+
+    The classmethods are the interface of a hash family, see HASH_FAMILIES:
+    draw a multiplier, round a table size and hash arrays of keys with one
+    multiplier and size per key.
+    '''
+    __slots__ = ('prime', 'allocated_space', 'k')
+    name = 'carter-wegman'
+
+    def __init__(self, prime, allocated_space, k=None):
         # it's okay to increase the size of the prime
         # do it to have a bigger random range
         if prime == 1:
             prime = 3
         self.prime = prime
         self.allocated_space = allocated_space
-        self.k = random.randrange(1, prime - 1)
+        # k is drawn from [1, prime - 1], python ints keep k * element exact
+        # for any universe size
+        self.k = self.draw(prime) if k is None else k
 
     def hash(self, element):
         '''Hash the element'''
         return (self.k * element % self.prime) % self.allocated_space
+
+    def hash_many(self, keys):
+        '''Hash a uint64 array of elements'''
+        return self.hash_arrays(self.k, np.uint64(self.allocated_space), keys, self.prime)
+
+    @staticmethod
+    def draw(prime):
+        '''A random multiplier'''
+        return random.randrange(1, prime)
+
+    @staticmethod
+    def draw_many(rng, prime, size):
+        '''size random multipliers from a numpy Generator'''
+        return rng.integers(1, prime, size=size, dtype=np.uint64)
+
+    @staticmethod
+    def table_size(space):
+        '''Number of slots for a table that needs space of them'''
+        return space
+
+    @staticmethod
+    def table_sizes(space):
+        '''table_size for an integer array'''
+        return space
+
+    @staticmethod
+    def hash_arrays(k, allocated_space, keys, prime):
+        '''Hash uint64 keys, k and allocated_space are uint64 scalars or arrays'''
+        return mulmod_many(k, keys, prime) % allocated_space
+
+    @staticmethod
+    def hash_one(k, allocated_space, element, prime):
+        '''hash with the parameters of a function instead of the object'''
+        return k * element % prime % allocated_space
     
     def __repr__(self):
         return "s: {}, k: {}".format(self.allocated_space, self.k)
 
 
-class Table:
-    def __init__(self, prime):
-        self.elements = []
-        self.element_count = 0
-        self.max_element_count = 0 # M
-        self.allocated_space = 0
+class MultiplyShiftHashFunction(HashFunction):
+    '''Dietzfelbinger's multiply-shift for power of two allocated_space
+
+    The location is the top log2(allocated_space) bits of k * element mod
+    2^64 for an odd k, no modulo at all, and with numpy the product simply
+    wraps around. Two elements collide with probability up to
+    2 / allocated_space, twice the bound of the prime family. prime is only
+    kept for the interface.
+    '''
+    __slots__ = ('shift',)
+    name = 'multiply-shift'
+
+    def __init__(self, prime, allocated_space, k=None):
+        # millions of these are created per RehashAll, so no super() call
         self.prime = prime
-        self.hash_function = None
+        self.allocated_space = allocated_space
+        self.k = random.getrandbits(64) | 1 if k is None else k
+        # 64 - log2(allocated_space), a shift by 65 leaves 0 for the bogus
+        # start function of no space
+        self.shift = 65 - allocated_space.bit_length()
+
+    def hash(self, element):
+        '''Hash the element'''
+        return (self.k * element & 0xFFFFFFFFFFFFFFFF) >> self.shift
+
+    @staticmethod
+    def draw(prime):
+        return random.getrandbits(64) | 1
+
+    @staticmethod
+    def draw_many(rng, prime, size):
+        return rng.integers(0, 2 ** 64 - 1, size=size, dtype=np.uint64, endpoint=True) | np.uint64(1)
+
+    @staticmethod
+    def table_size(space):
+        return 1 << max(0, space - 1).bit_length()
+
+    @staticmethod
+    def table_sizes(space):
+        # exact for sizes below 2^53
+        mantissa, exponent = np.frexp(space.astype(np.float64))
+        return np.where(mantissa == 0.5, space, np.ones_like(space) << exponent.astype(space.dtype))
+
+    @staticmethod
+    def hash_arrays(k, allocated_space, keys, prime):
+        bits = np.log2(allocated_space).astype(np.uint64)
+        # a shift by 64 is undefined, a table of one slot shifts twice
+        return (np.asarray(k, dtype=np.uint64) * keys >> (np.uint64(63) - bits)) >> np.uint64(1)
+
+    @staticmethod
+    def hash_one(k, allocated_space, element, prime):
+        return (k * element & 0xFFFFFFFFFFFFFFFF) >> (65 - allocated_space.bit_length())
+
+
+# name -> class of the hash functions, the hash_family option picks one.
+# Further families subclass HashFunction and register here.
+HASH_FAMILIES = {family.name: family for family in (HashFunction, MultiplyShiftHashFunction)}
+
+
+class SlotPool:
+    '''The slots of all subtables packed into one typed array
+
+    values holds the element of every slot as an unsigned 64-bit int and the
+    occupied bitmap has one bit per slot, a cleared bit marks a slot that is
+    either empty or deleted. A subtable owns the slots [offset, offset +
+    allocated_space). New regions are cut from the end of the pool, the
+    region a subtable grew out of stays unused until RehashAll builds a fresh
+    pool. The last reserved slots are empty slots nobody owns yet, allocate
+    hands them out before the arrays grow.
+    '''
+    def __init__(self, allocated_space=0):
+        self.values = array('Q', bytes(8 * allocated_space))
+        self.occupied = bytearray((allocated_space + 7) // 8)
+        # a list or typed array parallel to values if the slots carry
+        # payloads, see PayloadHashing
+        self.payload = None
+        self.reserved = 0
+        # concurrent batch lookups holding views of the arrays, growing waits
+        # until released sees the last of them go
+        self.readers = 0
+        self.released = threading.Condition()
+
+    def allocate(self, allocated_space):
+        '''Returns the offset of allocated_space new empty slots'''
+        offset = len(self.values) - self.reserved
+        if allocated_space <= self.reserved:
+            self.reserved -= allocated_space
+        else:
+            self.grow(allocated_space - self.reserved)
+            self.reserved = 0
+        return offset
+
+    def reserve(self, allocated_space):
+        '''Add allocated_space empty slots that later allocations take without growing'''
+        self.grow(allocated_space)
+        self.reserved += allocated_space
+
+    def grow(self, allocated_space):
+        '''Append allocated_space empty slots to the arrays'''
+        if not isinstance(self.values, array):
+            # the slots of a loaded snapshot, the mapping can't grow
+            values = array('Q')
+            values.frombytes(self.values.cast('B'))
+            self.values = values
+            self.occupied = bytearray(self.occupied)
+
+        offset = len(self.values)
+        with self.released:
+            # a view keeps an array from resizing, one held outside reading
+            # won't go away and raises BufferError
+            self.released.wait_for(lambda: not self.readers)
+            self.values.frombytes(bytes(8 * allocated_space))
+            self.occupied.extend(bytes((offset + allocated_space + 7) // 8 - len(self.occupied)))
+        if isinstance(self.payload, list):
+            self.payload.extend([None] * allocated_space)
+        elif self.payload is not None:
+            self.payload.frombytes(bytes(self.payload.itemsize * allocated_space))
+
+    @contextlib.contextmanager
+    def reading(self):
+        '''Hold while views of the arrays exist, grow waits for them'''
+        with self.released:
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.released:
+                self.readers -= 1
+                if not self.readers:
+                    self.released.notify_all()
+
+    def clear(self, offset, allocated_space):
+        '''Mark the slots of a region as empty'''
+        occupied = self.occupied
+        start = offset
+        stop = offset + allocated_space
+
+        # single bits up to the first and from the last byte boundary
+        while start < stop and start & 7:
+            occupied[start >> 3] &= ~(1 << (start & 7)) & 0xFF
+            start += 1
+        while stop > start and stop & 7:
+            stop -= 1
+            occupied[stop >> 3] &= ~(1 << (stop & 7)) & 0xFF
+
+        occupied[start >> 3:stop >> 3] = bytes((stop - start) >> 3)
+
+    def release(self, locations):
+        '''Reset the payloads of the slots, deleted elements don't keep theirs alive'''
+        payload = self.payload
+        default = None if isinstance(payload, list) else 0
+        for location in locations:
+            payload[location] = default
+
+    def live_slots(self, offset, allocated_space):
+        '''Returns the locations of all occupied slots in a region'''
+        occupied = self.occupied
+        stop = offset + allocated_space
+        result = []
+        for byte_index in range(offset >> 3, (stop + 7) >> 3):
+            byte = occupied[byte_index]
+            # skip eight empty slots at once
+            if byte:
+                base = byte_index << 3
+                for bit in range(8):
+                    location = base + bit
+                    if byte >> bit & 1 and offset <= location < stop:
+                        result.append(location)
+        return result
+
+    def live_values(self, offset, allocated_space):
+        '''Returns the elements of all occupied slots in a region'''
+        values = self.values
+        return [values[location] for location in self.live_slots(offset, allocated_space)]
+
+    def live_array(self, offsets=None, spaces=None):
+        '''Returns the elements of all occupied slots as a uint64 array
+
+        With offsets and spaces only the slots of these regions count, slots
+        that concurrent mode left behind may still be marked as occupied.
+        '''
+        return np.frombuffer(self.values, dtype=np.uint64)[self.live_slot_array(offsets, spaces)]
+
+    def live_slot_array(self, offsets=None, spaces=None):
+        '''live_array, but the locations of the slots instead of their elements'''
+        occupied = np.frombuffer(self.occupied, dtype=np.uint8)
+        bits = np.unpackbits(occupied, bitorder='little')[:len(self.values)].view(bool)
+        if offsets is not None:
+            offsets = np.frombuffer(offsets, dtype=np.uint64).astype(np.intp)
+            spaces = np.frombuffer(spaces, dtype=np.uint64).astype(np.intp)
+            # every slot index of every region
+            slots = (np.repeat(offsets - (np.cumsum(spaces) - spaces), spaces)
+                     + np.arange(int(spaces.sum())))
+            live = np.zeros(len(bits), dtype=bool)
+            live[slots] = True
+            bits = bits & live
+        return np.flatnonzero(bits)
+
+
+    def live_chunks(self, offsets, spaces, window):
+        '''Yield the elements of the occupied slots of the regions, window regions at a time
+
+        No view of the arrays is held while suspended, writes in between
+        may grow the pool.
+        '''
+        for start in range(0, len(offsets), window):
+            offset = np.array(offsets[start:start + window], dtype=np.intp)
+            space = np.array(spaces[start:start + window], dtype=np.intp)
+            # every slot index of every region
+            slots = np.repeat(offset - (np.cumsum(space) - space), space) + np.arange(int(space.sum()))
+
+            with self.reading():
+                occupied = np.frombuffer(self.occupied, dtype=np.uint8)
+                live = slots[occupied[slots >> 3] >> (slots & 7).astype(np.uint8) & 1 == 1]
+                del occupied
+                values = np.frombuffer(self.values, dtype=np.uint64)
+                piece = values[live]
+                del values
+            yield piece
+
 
-    def update(self, element_count):
+class Table:
+    '''Subtable, its slots are the region of the pool starting at offset'''
+    __slots__ = ('pool', 'index', 'offset', 'element_count', 'max_element_count',
+                 'allocated_space', 'prime', 'hash_function', 'family')
+
+    def __init__(self, prime, pool, index=0, offset=0, allocated_space=0,
+                 element_count=0, max_element_count=0, hash_function=None, family=None):
+        self.pool = pool
+        self.index = index
+        self.offset = offset
         self.element_count = element_count
+        self.max_element_count = max_element_count # M
+        self.allocated_space = allocated_space
+        self.prime = prime
+        self.hash_function = hash_function
+        self.family = HashFunction if family is None else family
 
-        # make space for at least two elements
-        element_count = max(1, element_count)
+    def update(self, element_count, compact=False):
+        self.element_count = element_count
 
         self.max_element_count = 2 * element_count
-        self.allocated_space = 2 * self.max_element_count * (self.max_element_count - 1)
-        self.elements = [Entry() for _ in range(self.allocated_space)]
-        self.hash_function = HashFunction(self.prime, self.allocated_space)
+        # an empty table doesn't count towards (**), it still gets a single
+        # slot so elements can be hashed into it
+        self.allocate(self.family.table_size(
+            max(1, sub_table_slots(self.max_element_count, compact))))
+        self.hash_function = self.family(self.prime, self.allocated_space)
+
+    def required_space(self):
+        '''Space of the table in the sense of (**)'''
+        return 2 * self.max_element_count * (self.max_element_count - 1)
+
+    def allocate(self, allocated_space):
+        '''Move the table to allocated_space new empty slots'''
+        # only live regions may have occupied bits
+        self.clear()
+        self.allocated_space = allocated_space
+        self.offset = self.pool.allocate(allocated_space)
+
+    def clear(self):
+        '''Mark every slot as empty'''
+        self.pool.clear(self.offset, self.allocated_space)
+        if self.pool.payload is not None and self.allocated_space:
+            self.pool.release(range(self.offset, self.offset + self.allocated_space))
+
+    def is_occupied(self, location):
+        location += self.offset
+        return self.pool.occupied[location >> 3] >> (location & 7) & 1
+
+    def value(self, location):
+        return self.pool.values[self.offset + location]
+
+    def store(self, location, element):
+        location += self.offset
+        self.pool.values[location] = element
+        self.pool.occupied[location >> 3] |= 1 << (location & 7)
+
+    def remove(self, location):
+        location += self.offset
+        self.pool.occupied[location >> 3] &= ~(1 << (location & 7)) & 0xFF
+        if self.pool.payload is not None:
+            self.pool.release((location,))
+
+    def live_slots(self):
+        '''Returns the pool locations of all occupied slots'''
+        return self.pool.live_slots(self.offset, self.allocated_space)
+
+    def live_values(self):
+        '''Returns the elements of all occupied slots'''
+        return self.pool.live_values(self.offset, self.allocated_space)
 
     def __repr__(self):
         return 'count: {}, max: {}, allocated: {}, hash: {}'.format(
             self.element_count, self.max_element_count,
             self.allocated_space, self.hash_function)
+
+
+class SnapshotTables(dict):
+    '''table_list of a loaded snapshot, builds the Table objects on first use
+
+    Indexing works like on the list, a missing subtable is created from the
+    arrays of the snapshot and kept. Being a dict, the lookup of an existing
+    table stays as cheap as in a list.
+    '''
+    def __init__(self, dynperf, element_count, max_element_count):
+        super().__init__()
+        self.dynperf = dynperf
+        self.element_count = element_count
+        self.max_element_count = max_element_count
+
+    def __missing__(self, index):
+        dynperf = self.dynperf
+        if not 0 <= index < dynperf.s:
+            raise IndexError('Subtable index out of range')
+
+        allocated_space = dynperf.sub_table_space[index]
+        table = Table(dynperf.prime, dynperf.pool, index, dynperf.sub_table_offset[index],
+                      allocated_space, self.element_count[index], self.max_element_count[index],
+                      dynperf.hash_family(dynperf.prime, allocated_space, dynperf.sub_table_k[index]),
+                      dynperf.hash_family)
+        # a concurrent writer may have put a replacement in meanwhile
+        return self.setdefault(index, table)
+
+    def __len__(self):
+        return self.dynperf.s
+
+    def __iter__(self):
+        return (self[index] for index in range(len(self)))
+
+    def counts(self):
+        '''element_count and max_element_count of every subtable'''
+        element_count = array('Q')
+        element_count.frombytes(self.element_count.cast('B'))
+        max_element_count = array('Q')
+        max_element_count.frombytes(self.max_element_count.cast('B'))
+        for index, table in dict.items(self):
+            element_count[index] = table.element_count
+            max_element_count[index] = table.max_element_count
+        return element_count, max_element_count
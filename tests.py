@@ -1,13 +1,43 @@
 #!/usr/bin/env python3
 '''Unit tests for dynamic-perfect-hashing'''
 
+import contextlib
+import multiprocessing
+import os
+import pickle
 import pprint
+import sys
+import tempfile
+import threading
 import unittest
 import random
+from concurrent.futures import ProcessPoolExecutor
 
 # use weird import because of invalid module name (my bad)
 DynPerf = __import__('dynamic-perfect-hashing').DynamicPerfectHashing
 HashFunction = __import__('dynamic-perfect-hashing').HashFunction
+is_prime = __import__('dynamic-perfect-hashing').is_prime
+mulmod_many = __import__('dynamic-perfect-hashing').mulmod_many
+np = __import__('dynamic-perfect-hashing').np
+PerfectHashMap = __import__('dynamic-perfect-hashing').PerfectHashMap
+ShardedPerfectHashing = __import__('dynamic-perfect-hashing').ShardedPerfectHashing
+SharedPerfectHashing = __import__('dynamic-perfect-hashing').SharedPerfectHashing
+KeyedPerfectHashing = __import__('dynamic-perfect-hashing').KeyedPerfectHashing
+fingerprint = __import__('dynamic-perfect-hashing').fingerprint
+
+@contextlib.contextmanager
+def using_numpy(numpy):
+    '''Let the module use numpy as given for the duration, None runs its pure Python fallbacks'''
+    module = __import__('dynamic-perfect-hashing')
+    saved, module.np = module.np, numpy
+    try:
+        yield
+    finally:
+        module.np = saved
+
+def locate_shared(name, elements, results):
+    with SharedPerfectHashing(name) as shared:
+        results.put((list(shared.locate_many(elements)), [shared.Locate(ele) for ele in elements]))
 
 class PredictableHash:
     def __init__(self, hasher):
@@ -26,6 +56,35 @@ class TestDynamicPerfectHashing(unittest.TestCase):
         dynperf = DynPerf(500)
         self.assertEqual(dynperf.prime, 503)
 
+    def test_calculate_prime_large_universe(self):
+        '''Prime selection has to be instant for 64-bit universes'''
+        dynperf = DynPerf(2 ** 61 - 2)
+        self.assertEqual(dynperf.prime, 2 ** 61 - 1)
+
+        dynperf = DynPerf(2 ** 63)
+        self.assertGreater(dynperf.prime, 2 ** 63)
+        self.assertTrue(is_prime(dynperf.prime))
+
+    def test_is_prime(self):
+        '''Compare against trial division'''
+        naive = [n for n in range(2000) if n > 1 and all(n % d for d in range(2, n))]
+        self.assertEqual([n for n in range(2000) if is_prime(n)], naive)
+        # strong pseudoprimes for the first few bases
+        self.assertFalse(is_prime(3215031751))
+        self.assertFalse(is_prime(3825123056546413051))
+
+    def test_large_keys(self):
+        universe_size = 2 ** 63
+        elements = [random.randrange(0, universe_size) for _ in range(200)] + [universe_size]
+
+        dynperf = DynPerf(universe_size)
+        for ele in elements:
+            dynperf.Insert(ele)
+
+        for ele in elements:
+            self.assertTrue(dynperf.Locate(ele))
+        self.assertFalse(dynperf.Locate(12345))
+
     def test_is_injective(self):
         '''Force collision with predictable hash''' 
         dynperf = DynPerf(2)
@@ -34,6 +93,7 @@ class TestDynamicPerfectHashing(unittest.TestCase):
 
     def test_simple(self):
         dynperf = DynPerf(2)
+        self.assertFalse(dynperf.Locate(1))
 
         dynperf.Insert(1)
         self.assertEqual(dynperf.count, 1)
@@ -158,13 +218,1039 @@ class TestDynamicPerfectHashing(unittest.TestCase):
         for i in range(6):
             self.assertFalse(dynperf.Locate(i))
 
+    def test_compact_storage(self):
+        '''Slots live in one typed array and an occupancy bitmap per subtable'''
+        dynperf = DynPerf(2 ** 63)
+        elements = [random.randrange(0, 2 ** 63) for _ in range(100)]
+        for ele in elements:
+            dynperf.Insert(ele)
+
+        pool = dynperf.pool
+        self.assertEqual(pool.values.itemsize, 8)
+        self.assertEqual(len(pool.occupied), (len(pool.values) + 7) // 8)
+
+        stored = []
+        for table in dynperf.table_list:
+            self.assertLessEqual(table.offset + table.allocated_space, len(pool.values))
+            stored.extend(table.live_values())
+        self.assertEqual(sorted(stored), sorted(set(elements)))
+
+        self.assertRaises(ValueError, DynPerf, 2 ** 64)
+
+    @unittest.skipIf(np is None, 'numpy is not installed')
+    def test_mulmod_many(self):
+        '''Compare against python ints for the direct, long double and object paths'''
+        for prime in (503, 2 ** 61 - 1, 2 ** 63 + 29):
+            keys = [random.randrange(0, prime) for _ in range(1000)] + [0, prime - 1]
+            k = random.randrange(1, prime)
+            expected = [k * key % prime for key in keys]
+            result = mulmod_many(k, np.array(keys, dtype=np.uint64), prime)
+            self.assertEqual(result.tolist(), expected)
+
+    def test_batch(self):
+        for universe_size in (5000, 2 ** 40, 2 ** 63):
+            dynperf = DynPerf(universe_size)
+            elements = [random.randrange(0, universe_size) for _ in range(3000)]
+            inserted = set(elements[:2000])
+            for ele in elements[:100]:
+                dynperf.Insert(ele)
+
+            # grows past M in one go, then takes the vectorized store
+            dynperf.insert_many(elements[:1000])
+            dynperf.insert_many(elements[1000:2000])
+            self.assertEqual(dynperf.count, len(inserted))
+
+            mask = dynperf.locate_many(elements)
+            self.assertEqual(list(mask), [ele in inserted for ele in elements])
+            for ele in elements:
+                self.assertEqual(dynperf.Locate(ele), ele in inserted)
+
+            deleted = list(inserted)[:500]
+            dynperf.delete_many(deleted)
+            self.assertEqual(dynperf.count, len(inserted) - 500)
+            self.assertFalse(any(dynperf.locate_many(deleted)))
+            self.assertTrue(all(dynperf.locate_many(list(inserted)[500:])))
+
+            self.assertRaises(ValueError, dynperf.locate_many, [universe_size + 1])
+            self.assertRaises(ValueError, dynperf.insert_many, [-1])
+            # all or nothing
+            self.assertRaises(ValueError, dynperf.delete_many, deleted[:1] + list(inserted)[500:510])
+            self.assertTrue(all(dynperf.locate_many(list(inserted)[500:510])))
+
+    def test_batch_without_numpy(self):
+        with using_numpy(None):
+            dynperf = DynPerf(1000)
+            dynperf.insert_many(range(0, 1000, 3))
+            self.assertEqual(dynperf.locate_many([0, 1, 3]), [True, False, True])
+            dynperf.delete_many([0, 3])
+            self.assertEqual(dynperf.locate_many([0, 1, 3, 6]), [False, False, False, True])
+
+    def test_from_keys(self):
+        universe_size = 2 ** 40
+        elements = [random.randrange(0, universe_size) for _ in range(5000)]
+        elements += elements[:100]
+
+        dynperf = DynPerf.from_keys(iter(elements), universe_size)
+        self.assertEqual(dynperf.count, len(set(elements)))
+        self.assertEqual(len(dynperf.table_list), 2 * (dynperf.count - 1))
+        for ele in elements:
+            self.assertTrue(dynperf.Locate(ele))
+
+        # still fully dynamic
+        for ele in elements[:50]:
+            dynperf.Delete(ele)
+            self.assertFalse(dynperf.Locate(ele))
+        extra = [random.randrange(0, universe_size) for _ in range(5000)]
+        for ele in extra:
+            dynperf.Insert(ele)
+        for ele in extra + elements[50:5000]:
+            self.assertTrue(dynperf.Locate(ele))
+
+        self.assertEqual(DynPerf.from_keys([], 10).count, 0)
+        self.assertRaises(ValueError, DynPerf.from_keys, [11], 10)
+
+    def test_from_keys_without_numpy(self):
+        with using_numpy(None):
+            dynperf = DynPerf.from_keys([5, 3, 5, 900], 1000)
+            self.assertEqual(dynperf.count, 3)
+            self.assertEqual([dynperf.Locate(ele) for ele in (3, 4, 5, 900)], [True, False, True, True])
+
+    def test_incremental_delete_many(self):
+        '''Deletes of a batch stay deleted when the migration completes partway through it'''
+        dynperf = DynPerf(2 ** 40, incremental=True, rehash_step=64)
+        elements = []
+        for ele in random.sample(range(2 ** 40), 4000):
+            dynperf.Insert(ele)
+            elements.append(ele)
+            if dynperf.migration is not None and len(elements) > 1000:
+                break
+
+        dynperf.delete_many(elements[:-10])
+        # the swap may have started a shrink right away
+        dynperf.finish_migration()
+        self.assertEqual(dynperf.count, 10)
+        self.assertFalse(any(dynperf.locate_many(elements[:-10])))
+        self.assertTrue(all(dynperf.locate_many(elements[-10:])))
+
+    def test_migration_steps(self):
+        '''A build step only fills slots and per-table entries allocated when partitioning ended'''
+        dynperf = DynPerf(2 ** 40, incremental=True, rehash_step=64)
+        elements = random.sample(range(2 ** 40), 20000)
+        inserted = 0
+        while dynperf.migration is None or dynperf.migration.phase != dynperf.migration.build:
+            dynperf.Insert(elements[inserted])
+            inserted += 1
+
+        migration = dynperf.migration
+        target = migration.target
+        values, occupied = target.pool.values, target.pool.occupied
+        slots = len(values)
+        self.assertEqual(len(target.table_list), migration.s)
+        while dynperf.migration is migration and migration.phase == migration.build:
+            position = migration.position
+            dynperf.Insert(elements[inserted])
+            inserted += 1
+            # the budget bounds the tables of a step, none of them grows the pool
+            self.assertLessEqual(migration.position - position, dynperf.rehash_step)
+            self.assertIs(target.pool.values, values)
+            self.assertIs(target.pool.occupied, occupied)
+            self.assertEqual(len(values), slots)
+            self.assertEqual(len(target.table_list), migration.s)
+
+        dynperf.finish_migration()
+        self.assertEqual(dynperf.count, inserted)
+        self.assertTrue(all(dynperf.locate_many(elements[:inserted])))
+
+    def test_incremental_rehash(self):
+        '''After the first build RehashAll is never run in one go'''
+        universe_size = 2 ** 40
+        dynperf = DynPerf(universe_size, incremental=True, rehash_step=16)
+        dynperf.Insert(0)
+
+        full_rehashes = []
+        rehash_with = dynperf.rehash_with
+        dynperf.rehash_with = lambda elements: (full_rehashes.append(elements), rehash_with(elements))
+
+        present = {0}
+        migrations = 0
+        for _ in range(20000):
+            if present and random.random() < 0.3:
+                ele = random.choice(tuple(present))
+                dynperf.Delete(ele)
+                present.discard(ele)
+            else:
+                ele = random.randrange(0, universe_size)
+                dynperf.Insert(ele)
+                present.add(ele)
+            if dynperf.migration is not None:
+                migrations += 1
+            self.assertTrue(ele in present and dynperf.Locate(ele) or
+                            ele not in present and not dynperf.Locate(ele))
+
+        self.assertEqual(full_rehashes, [])
+        self.assertGreater(migrations, 0)
+
+        dynperf.finish_migration()
+        self.assertIsNone(dynperf.migration)
+        self.assertEqual(dynperf.count, len(present))
+        self.assertTrue(all(dynperf.locate_many(list(present))))
+        self.assertEqual(sorted(dynperf.pool.live_array().tolist()), sorted(present))
+
+    def test_space_total(self):
+        '''The running (**) total matches a full recount'''
+        for incremental in (False, True):
+            dynperf = DynPerf(2 ** 40, incremental=incremental, debug=True)
+            for _ in range(3000):
+                dynperf.Insert(random.randrange(0, 2 ** 40))
+            dynperf.finish_migration()
+            dynperf.check_space_total()
+            self.assertEqual(dynperf.s, len(dynperf.table_list))
+
+        # empty subtables get a single slot that doesn't count towards (**)
+        empty = [table for table in dynperf.table_list if table.element_count == 0]
+        self.assertTrue(all(table.required_space() == 0 and table.allocated_space == 1 for table in empty))
+
+        dynperf.sub_table_space_total += 1
+        self.assertRaises(RuntimeError, dynperf.check_space_total)
+
+    def test_find_injective(self):
+        dynperf = DynPerf(2 ** 40)
+        for size in (5, 200):
+            elements = random.sample(range(2 ** 40), size)
+            # tight enough that most candidates collide
+            allocated_space = size * size // 2
+            hash_function = dynperf.find_injective(elements, allocated_space)
+            self.assertTrue(dynperf.is_injective(elements, hash_function))
+            self.assertEqual(hash_function.allocated_space, allocated_space)
+
+        self.assertEqual(sum(dynperf.injective_attempts.values()), 2)
+        self.assertGreaterEqual(min(dynperf.injective_attempts), 1)
+
+        dynperf = DynPerf.from_keys(random.sample(range(2 ** 40), 3000), 2 ** 40)
+        self.assertEqual(sum(dynperf.injective_attempts.values()),
+                         sum(1 for table in dynperf.table_list if table.element_count))
+
+    @unittest.skipIf(np is None, 'numpy is not installed')
+    def test_parallel_rebuild(self):
+        module = __import__('dynamic-perfect-hashing')
+        chunk, module.PARALLEL_CHUNK = module.PARALLEL_CHUNK, 500
+        try:
+            elements = random.sample(range(2 ** 40), 5000)
+            with ProcessPoolExecutor(max_workers=2) as executor:
+                dynperf = DynPerf.from_keys(elements, 2 ** 40, executor=executor,
+                                            parallel_threshold=1000, debug=True)
+
+                self.assertEqual(dynperf.count, len(elements))
+                self.assertTrue(all(dynperf.locate_many(elements)))
+                for ele in elements[:100]:
+                    self.assertTrue(dynperf.Locate(ele))
+                self.assertEqual(sorted(dynperf.pool.live_array().tolist()), sorted(elements))
+
+                # the next RehashAll goes through the executor as well
+                extra = random.sample(range(2 ** 40), 5000)
+                dynperf.insert_many(extra)
+                self.assertTrue(all(dynperf.locate_many(elements + extra)))
+        finally:
+            module.PARALLEL_CHUNK = chunk
+
+    def test_stats(self):
+        for incremental in (False, True):
+            events = []
+            dynperf = DynPerf(2 ** 40, incremental=incremental, stats=True,
+                              on_rehash_start=lambda d: events.append('start'),
+                              on_rehash_end=lambda d, seconds: events.append(seconds))
+            elements = random.sample(range(2 ** 40), 3000)
+            for ele in elements:
+                dynperf.Insert(ele)
+            for ele in elements[:1000]:
+                dynperf.Delete(ele)
+            dynperf.finish_migration()
+
+            stats = dynperf.statistics()
+            self.assertGreater(stats['rehashes'], 0)
+            self.assertEqual(events[::2], ['start'] * stats['rehashes'])
+            self.assertAlmostEqual(sum(events[1::2]), stats['rehash_seconds'])
+            self.assertEqual(max(events[1::2]), stats['max_rehash_seconds'])
+            self.assertGreaterEqual(stats['top_level_attempts'], stats['rehashes'])
+            self.assertEqual(stats['elements'], 2000)
+            self.assertEqual(stats['allocated_slots'], len(dynperf.pool.values))
+            self.assertEqual(stats['migrations'] > 0, incremental)
+
+        # disabled by default, the gauges are still there
+        dynperf = DynPerf(100)
+        dynperf.Insert(1)
+        self.assertIsNone(dynperf.stats)
+        self.assertNotIn('rehashes', dynperf.statistics())
+        self.assertEqual(dynperf.statistics()['elements'], 1)
+
+    def test_snapshot(self):
+        elements = random.sample(range(2 ** 40), 5000)
+        dynperf = DynPerf(2 ** 40)
+        for ele in elements:
+            dynperf.Insert(ele)
+        for ele in elements[:500]:
+            dynperf.Delete(ele)
+        missing = random.sample(range(2 ** 40), 1000)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'table.dph')
+            dynperf.save(path)
+
+            for mmap in (True, False):
+                loaded = DynPerf.load(path, mmap=mmap, debug=True)
+                self.assertEqual(loaded.count, dynperf.count)
+                self.assertEqual(list(loaded.locate_many(elements)),
+                                 list(dynperf.locate_many(elements)))
+                for ele in elements[:1000] + missing[:100]:
+                    self.assertEqual(loaded.Locate(ele), dynperf.Locate(ele))
+                loaded.check_space_total()
+
+                # writes work on the loaded tables, growing moves the slots
+                # off the mapping
+                for ele in elements[:500]:
+                    loaded.Insert(ele)
+                for ele in elements[500:1000]:
+                    loaded.Delete(ele)
+                for ele in missing:
+                    loaded.Insert(ele)
+                live = elements[:500] + elements[1000:] + missing
+                self.assertTrue(all(loaded.locate_many(live)))
+                self.assertFalse(any(loaded.locate_many(elements[500:1000])))
+
+                # a loaded table saves again
+                path_again = os.path.join(directory, 'again.dph')
+                loaded.save(path_again)
+                self.assertTrue(all(DynPerf.load(path_again, mmap=mmap).locate_many(live)))
+
+            # the file itself is never written through the mapping
+            self.assertTrue(all(DynPerf.load(path).locate_many(elements[500:])))
+
+            DynPerf(100).save(path)
+            empty = DynPerf.load(path)
+            self.assertFalse(empty.Locate(1))
+            empty.Insert(1)
+            self.assertTrue(empty.Locate(1))
+
+            with open(path, 'wb') as snapshot:
+                snapshot.write(b'not a snapshot' * 10)
+            self.assertRaises(ValueError, DynPerf.load, path)
+
+    def test_concurrent(self):
+        '''Readers never miss a stored element while a writer rebuilds'''
+        dynperf = DynPerf(2 ** 40, concurrent=True)
+        stable = random.sample(range(2 ** 40), 1000)
+        dynperf.insert_many(stable)
+
+        stop = threading.Event()
+        misses = []
+        def reader(batch):
+            while not stop.is_set():
+                if batch:
+                    misses.append(len(stable) - int(dynperf.locate_many(stable).sum()))
+                else:
+                    misses.append(sum(not dynperf.Locate(ele) for ele in stable[:200]))
+
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-5)
+        readers = [threading.Thread(target=reader, args=(batch,)) for batch in (False, True, False)]
+        try:
+            for thread in readers:
+                thread.start()
+            extra = random.sample(range(2 ** 40), 8000)
+            for ele in extra:
+                dynperf.Insert(ele)
+            for ele in extra[:4000]:
+                dynperf.Delete(ele)
+        finally:
+            stop.set()
+            for thread in readers:
+                thread.join()
+            sys.setswitchinterval(interval)
+
+        self.assertTrue(misses)
+        self.assertEqual(sum(misses), 0)
+        self.assertTrue(all(dynperf.locate_many(stable + extra[4000:])))
+        self.assertFalse(any(dynperf.locate_many(extra[:4000])))
+        self.assertEqual(sorted(dynperf.pool.live_array(dynperf.sub_table_offset,
+                                                       dynperf.sub_table_space).tolist()),
+                         sorted(stable + extra[4000:]))
+
+    @unittest.skipIf(np is None, 'numpy is not installed')
+    def test_concurrent_grow(self):
+        '''Growing the pool waits for the readers holding views, a view held elsewhere raises'''
+        dynperf = DynPerf(2 ** 40, concurrent=True)
+        dynperf.insert_many(random.sample(range(2 ** 40), 1000))
+        pool = dynperf.pool
+        size = len(pool.values)
+
+        reading = threading.Event()
+        done = threading.Event()
+        grown = []
+        def reader():
+            with pool.reading():
+                view = np.frombuffer(pool.values, dtype=np.uint64)
+                reading.set()
+                # the writer has to wait for this view to go
+                grown.append(done.wait(0.2))
+                del view
+
+        thread = threading.Thread(target=reader)
+        thread.start()
+        reading.wait()
+        pool.grow(64)
+        done.set()
+        thread.join()
+        self.assertEqual(grown, [False])
+        self.assertEqual(len(pool.values), size + 64)
+        self.assertEqual(len(pool.occupied), (size + 64 + 7) // 8)
+
+        view = np.frombuffer(pool.values, dtype=np.uint64)
+        self.assertRaises(BufferError, pool.grow, 64)
+        del view
+
+    def test_background_rehash(self):
+        dynperf = DynPerf(2 ** 40, background=True, stats=True)
+        elements = random.sample(range(2 ** 40), 20000)
+        for ele in elements[:10000]:
+            dynperf.Insert(ele)
+            # the current generation answers while a worker rebuilds
+            self.assertTrue(dynperf.Locate(ele))
+        dynperf.insert_many(elements[10000:])
+        for ele in elements[:5000]:
+            dynperf.Delete(ele)
+        dynperf.delete_many(elements[5000:6000])
+        dynperf.finish_migration()
+
+        self.assertIsNone(dynperf.migration)
+        self.assertIsNone(dynperf.worker)
+        self.assertGreater(dynperf.stats.migrations, 0)
+        # the very first RehashAll has no tables to serve from, it runs inline
+        self.assertEqual(dynperf.stats.migrations + 1, dynperf.stats.rehashes)
+        self.assertEqual(dynperf.count, 14000)
+        self.assertTrue(all(dynperf.locate_many(elements[6000:])))
+        self.assertFalse(any(dynperf.locate_many(elements[:6000])))
+        dynperf.check_space_total()
+
+    def test_sharded(self):
+        elements = random.sample(range(2 ** 40), 20000)
+        with ShardedPerfectHashing(2 ** 40, shards=3) as sharded:
+            sharded.insert_many(elements[:19000])
+            for ele in elements[19000:19100]:
+                sharded.Insert(ele)
+            self.assertEqual(sharded.count, 19100)
+            self.assertTrue(all(sharded.locate_many(elements[:19100])))
+            self.assertFalse(any(sharded.locate_many(elements[19100:])))
+
+            sharded.delete_many(elements[:1000])
+            sharded.Delete(elements[1000])
+            self.assertFalse(sharded.Locate(elements[1000]))
+            self.assertTrue(sharded.Locate(elements[1001]))
+            self.assertEqual(sharded.count, 18099)
+
+            self.assertRaises(ValueError, sharded.Delete, elements[0])
+            self.assertRaises(ValueError, sharded.Insert, 2 ** 41)
+            # an error in one shard leaves the others in step
+            self.assertRaises(AttributeError, sharded.call, 'no_such_operation', elements[:100])
+            self.assertTrue(sharded.Locate(elements[1001]))
+
+    def test_shared_memory(self):
+        elements = random.sample(range(2 ** 40), 5000)
+        dynperf = DynPerf.from_keys(elements[:4000], 2 ** 40)
+        dynperf.Delete(elements[0])
+        expected = [ele in set(elements[1:4000]) for ele in elements]
+
+        segment = dynperf.share()
+        try:
+            # a later write doesn't show up in the segment
+            dynperf.Insert(elements[4000])
+            with SharedPerfectHashing(segment.name) as shared:
+                self.assertEqual(shared.count, 3999)
+                self.assertEqual(list(shared.locate_many(elements)), expected)
+                self.assertEqual([shared.Locate(ele) for ele in elements[3990:4010]],
+                                 expected[3990:4010])
+                self.assertRaises(ValueError, shared.Locate, 2 ** 41)
+
+            results = multiprocessing.Queue()
+            process = multiprocessing.Process(target=locate_shared,
+                                              args=(segment.name, elements, results))
+            process.start()
+            self.assertEqual(results.get(timeout=60), (expected, expected))
+            process.join()
+        finally:
+            segment.close()
+            segment.unlink()
+
+    def test_map(self):
+        for typecode in (None, 'd'):
+            for incremental in (False, True):
+                mapping = PerfectHashMap(2 ** 40, typecode=typecode, incremental=incremental)
+                expected = {}
+                keys = random.sample(range(2 ** 40), 5000)
+                for index, key in enumerate(keys):
+                    mapping.put(key, float(index))
+                    expected[key] = float(index)
+                # overwrite and remove some, the values have to follow their
+                # keys through every rebuild
+                for key in keys[:1000]:
+                    mapping[key] = -1.0
+                    expected[key] = -1.0
+                for key in keys[1000:2000]:
+                    self.assertEqual(mapping.pop(key), expected.pop(key))
+                mapping.finish_migration()
+
+                self.assertEqual(mapping.count, len(expected))
+                for key, value in expected.items():
+                    self.assertEqual(mapping[key], value)
+                self.assertIsNone(mapping.get(keys[1500]))
+                self.assertEqual(mapping.get(keys[1500], 0.5), 0.5)
+                self.assertEqual(mapping.pop(keys[1500], 0.5), 0.5)
+                self.assertRaises(KeyError, mapping.__getitem__, keys[1500])
+                self.assertRaises(KeyError, mapping.pop, keys[1500])
+
+    def test_map_payload_slots(self):
+        '''Values go into the new slots with their keys and are reset when the key goes'''
+        mapping = PerfectHashMap(1000, typecode='q')
+        mapping.put(7, 700)
+        self.assertEqual(mapping.pop(7), 700)
+        self.assertRaises(NotImplementedError, mapping.Insert, 7)
+        self.assertRaises(NotImplementedError, mapping.insert_many, [7])
+        mapping.put(7, 1)
+        mapping.put(8, 2)
+        mapping.Delete(8)
+        mapping.delete_many([7])
+        self.assertFalse(any(mapping.pool.payload))
+
+        # overwrite every value while the new generation is built
+        mapping = PerfectHashMap(2 ** 40, typecode='q', incremental=True, rehash_step=16)
+        expected = {}
+        for key in random.sample(range(2 ** 40), 3000):
+            mapping.put(key, key % 1000)
+            expected[key] = key % 1000
+            if mapping.migration is not None and len(expected) > 1000:
+                break
+        for key in expected:
+            mapping[key] = -expected[key]
+            expected[key] = -expected[key]
+        mapping.finish_migration()
+        self.assertEqual({key: mapping[key] for key in expected}, expected)
+
+    def test_keyed(self):
+        # stable across processes, equal keys share a fingerprint
+        self.assertEqual(fingerprint('abc'), 1649259832005584963)
+        self.assertEqual(fingerprint(1), fingerprint(1.0))
+        self.assertNotEqual(fingerprint('abc'), fingerprint(b'abc'))
+        self.assertRaises(TypeError, fingerprint, [1])
+
+        for numpy in (np, None):
+            with using_numpy(numpy):
+                for incremental in (False, True):
+                    keyed = KeyedPerfectHashing(incremental=incremental)
+                    keys = (['key%d' % i for i in range(3000)] + [b'id%d' % i for i in range(1000)]
+                            + [(i, 'a') for i in range(1000)] + [None, 2.5, -7])
+                    for key in keys[:2000]:
+                        keyed.Insert(key)
+                    keyed.insert_many(keys[1000:])
+                    keyed.table.finish_migration()
+
+                    self.assertEqual(keyed.count, len(keys))
+                    self.assertTrue(all(keyed.locate_many(keys)))
+                    self.assertFalse(any(keyed.locate_many(['x%d' % i for i in range(100)])))
+                    for key in keys[:2500]:
+                        keyed.Delete(key)
+                    self.assertFalse(any(keyed.Locate(key) for key in keys[:2500]))
+                    self.assertTrue(all(keyed.Locate(key) for key in keys[2500:]))
+                    self.assertRaises(ValueError, keyed.Delete, 'key0')
+
+    def test_keyed_collision(self):
+        module = __import__('dynamic-perfect-hashing')
+        saved, module.fingerprint = module.fingerprint, lambda key: 7
+        try:
+            keyed = KeyedPerfectHashing()
+            keyed.Insert('a')
+            keyed.Insert('b')
+            keyed.Insert('b')
+            self.assertEqual(keyed.count, 2)
+            self.assertTrue(keyed.Locate('a'))
+            self.assertTrue(keyed.Locate('b'))
+            self.assertFalse(keyed.Locate('c'))
+
+            # the colliding key moves into the slot
+            keyed.Delete('a')
+            self.assertFalse(keyed.Locate('a'))
+            self.assertTrue(keyed.Locate('b'))
+            self.assertEqual(keyed.overflow, {})
+            self.assertEqual(keyed.count, 1)
+        finally:
+            module.fingerprint = saved
+
+    def test_bitmap(self):
+        for numpy in (np, None):
+            with using_numpy(numpy):
+                # 10000 bits are far less than the hashed form of 1000 elements
+                dynperf = DynPerf(10000, storage='auto')
+                elements = random.sample(range(10001), 2000)
+                for ele in elements[:1000]:
+                    dynperf.Insert(ele)
+                self.assertIsNotNone(dynperf.bitmap)
+                self.assertEqual(dynperf.table_list, [])
+                dynperf.insert_many(elements[1000:1500])
+                dynperf.Insert(elements[0])
+                dynperf.delete_many(elements[:100])
+                dynperf.Delete(elements[100])
+                self.assertRaises(ValueError, dynperf.Delete, elements[100])
+                self.assertRaises(ValueError, dynperf.Insert, 10001)
+
+                expected = set(elements[101:1500])
+                self.assertEqual(dynperf.count, len(expected))
+                self.assertEqual(list(dynperf.locate_many(elements)),
+                                 [ele in expected for ele in elements])
+                self.assertEqual(dynperf.statistics()['storage'], 'bitmap')
+
+                # a wider universe goes back to hashing
+                dynperf.widen_universe(2 ** 40)
+                self.assertIsNone(dynperf.bitmap)
+                self.assertEqual(dynperf.count, len(expected))
+                self.assertTrue(all(dynperf.Locate(ele) == (ele in expected) for ele in elements))
+                dynperf.Insert(2 ** 40)
+                self.assertTrue(dynperf.Locate(2 ** 40))
+                self.assertRaises(ValueError, dynperf.widen_universe, 10000)
+
+        # a large universe stays hashed with auto, bitmap forces the bitmap
+        dynperf = DynPerf.from_keys(range(0, 10000, 3), 2 ** 40, storage='auto')
+        self.assertIsNone(dynperf.bitmap)
+        dynperf = DynPerf.from_keys(range(0, 10000, 3), 20000, storage='bitmap')
+        self.assertEqual(len(dynperf.bitmap), 2501)
+        self.assertEqual(dynperf.count, 3334)
+        self.assertTrue(dynperf.Locate(9999))
+        self.assertFalse(dynperf.Locate(9998))
+        self.assertRaises(ValueError, DynPerf, 100, storage='sparse')
+
+        # an incremental RehashAll switches too, writes in between included
+        for background in (False, True):
+            dynperf = DynPerf(10000, storage='auto', incremental=True, background=background)
+            elements = random.sample(range(10001), 1000)
+            for ele in elements:
+                dynperf.Insert(ele)
+            dynperf.Delete(elements[0])
+            dynperf.finish_migration()
+            self.assertIsNotNone(dynperf.bitmap)
+            self.assertEqual(dynperf.count, 999)
+            self.assertEqual(list(dynperf.locate_many(elements)), [False] + [True] * 999)
+
+    def test_hash_families(self):
+        self.assertRaises(ValueError, DynPerf, 100, hash_family='md5')
+        for numpy in (np, None):
+            with using_numpy(numpy):
+                for incremental in (False, True):
+                    dynperf = DynPerf(2 ** 64 - 60, incremental=incremental,
+                                      hash_family='multiply-shift')
+                    elements = random.sample(range(2 ** 62), 3000)
+                    for ele in elements[:2000]:
+                        dynperf.Insert(ele)
+                    dynperf.insert_many(elements[2000:2500])
+                    dynperf.delete_many(elements[:500])
+                    dynperf.finish_migration()
+
+                    expected = [ele in set(elements[500:2500]) for ele in elements]
+                    self.assertEqual(dynperf.count, 2000)
+                    self.assertEqual(list(dynperf.locate_many(elements)), expected)
+                    self.assertEqual([dynperf.Locate(ele) for ele in elements], expected)
+                    # tables are rounded up to powers of two
+                    for table in dynperf.table_list:
+                        self.assertEqual(table.allocated_space & (table.allocated_space - 1), 0)
+                    self.assertEqual(len(dynperf.table_list) & (len(dynperf.table_list) - 1), 0)
+
+        elements = random.sample(range(2 ** 40), 2000)
+        dynperf = DynPerf.from_keys(elements, 2 ** 40, hash_family='multiply-shift')
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'snapshot')
+            dynperf.save(path)
+            loaded = DynPerf.load(path)
+            self.assertIs(loaded.hash_family, dynperf.hash_family)
+            loaded = DynPerf.load(path, hash_family='multiply-shift')
+            self.assertIs(loaded.hash_family, dynperf.hash_family)
+            self.assertRaises(ValueError, DynPerf.load, path, hash_family='carter-wegman')
+            self.assertTrue(all(loaded.locate_many(elements)))
+            self.assertTrue(all(loaded.Locate(ele) for ele in elements[:100]))
+
+    def test_compact(self):
+        elements = random.sample(range(2 ** 40), 6000)
+        for family in ('carter-wegman', 'multiply-shift'):
+            for numpy in (np, None):
+                with using_numpy(numpy):
+                    dynperf = DynPerf.from_keys(elements[:3000], 2 ** 40, compact=True,
+                                                hash_family=family)
+                    for ele in elements[3000:5000]:
+                        dynperf.Insert(ele)
+                    for ele in elements[:1000]:
+                        dynperf.Delete(ele)
+
+                expected = [ele in set(elements[1000:5000]) for ele in elements]
+                self.assertEqual(dynperf.count, 4000)
+                self.assertEqual([dynperf.Locate(ele) for ele in elements], expected)
+                # a quarter of the paper's space, (**) still counts the full one
+                for table in dynperf.table_list:
+                    m = table.max_element_count
+                    self.assertLessEqual(m, table.allocated_space)
+                    # rounded up to a power of two at most
+                    self.assertLessEqual(table.allocated_space, max(1, 2 * max(m, m * (m - 1) // 2)))
+                dynperf.check_space_total()
+
+        full = DynPerf.from_keys(elements, 2 ** 40)
+        compact = DynPerf.from_keys(elements, 2 ** 40, compact=True)
+        self.assertLess(len(compact.pool.values), len(full.pool.values) / 2)
+        self.assertTrue(all(compact.locate_many(elements)))
+
+    def test_shrink_after_migration(self):
+        '''A migration that completes during deletes is followed by the shrink it missed'''
+        for batch in (False, True):
+            dynperf = DynPerf(2 ** 40, incremental=True, rehash_step=64, shrink_below=0.25)
+            elements = []
+            # until the migration has taken its snapshot of the elements
+            for ele in random.sample(range(2 ** 40), 4000):
+                dynperf.Insert(ele)
+                elements.append(ele)
+                migration = dynperf.migration
+                if migration is not None and len(elements) > 1000 and \
+                        migration.phase != migration.collect:
+                    break
+
+            if batch:
+                dynperf.delete_many(elements[:-10])
+            else:
+                for ele in elements[:-10]:
+                    dynperf.Delete(ele)
+            dynperf.finish_migration()
+            self.assertEqual(dynperf.count, 10)
+            self.assertFalse(dynperf.should_shrink())
+            self.assertTrue(all(dynperf.locate_many(elements[-10:])))
+
+    def test_shrink(self):
+        # a failed Delete changes nothing, not even if the slot holds another element
+        dynperf = DynPerf(30)
+        for ele in range(0, 30, 3):
+            dynperf.Insert(ele)
+        for ele in range(1, 30, 3):
+            self.assertRaises(ValueError, dynperf.Delete, ele)
+        self.assertEqual(dynperf.count, 10)
+        self.assertTrue(all(dynperf.Locate(ele) for ele in range(0, 30, 3)))
+        self.assertRaises(ValueError, DynPerf(30).Delete, 3)
+        # shrinking is opt-in
+        self.assertIsNone(DynPerf(30).shrink_below)
+
+        for incremental in (False, True):
+            for shrink_below in (0.25, None):
+                dynperf = DynPerf(2 ** 40, incremental=incremental, stats=True,
+                                  shrink_below=shrink_below)
+                elements = random.sample(range(2 ** 40), 8000)
+                for ele in elements:
+                    dynperf.Insert(ele)
+                dynperf.finish_migration()
+                peak = len(dynperf.pool.values)
+
+                for ele in elements[:6000]:
+                    dynperf.Delete(ele)
+                dynperf.delete_many(elements[6000:7800])
+                dynperf.finish_migration()
+
+                self.assertEqual(dynperf.count, 200)
+                self.assertFalse(any(dynperf.locate_many(elements[:7800])))
+                self.assertTrue(all(dynperf.Locate(ele) for ele in elements[7800:]))
+                if shrink_below is None:
+                    self.assertEqual(dynperf.stats.shrinks, 0)
+                    self.assertEqual(len(dynperf.pool.values), peak)
+                else:
+                    # sized for the working set, not for the peak
+                    self.assertGreater(dynperf.stats.shrinks, 0)
+                    self.assertLessEqual(dynperf.M, 4 * 200)
+                    self.assertLess(len(dynperf.pool.values), peak / 10)
+
+    def test_iteration(self):
+        elements = random.sample(range(2 ** 40), 5000)
+        for numpy in (np, None):
+            with using_numpy(numpy):
+                for options in ({}, {'concurrent': True}, {'compact': True}):
+                    dynperf = DynPerf.from_keys(elements[:4000], 2 ** 40, **options)
+                    dynperf.delete_many(elements[:500])
+                    chunks = list(dynperf.iter_chunks(1000))
+                    self.assertEqual([len(chunk) for chunk in chunks], [1000, 1000, 1000, 500])
+                    self.assertEqual(sorted(ele for chunk in chunks for ele in chunk),
+                                     sorted(elements[500:4000]))
+                    self.assertEqual(sorted(dynperf), sorted(elements[500:4000]))
+                    self.assertEqual(len(dynperf), 3500)
+                    self.assertIn(elements[500], dynperf)
+                    self.assertNotIn(elements[0], dynperf)
+                    self.assertNotIn(-1, dynperf)
+                    self.assertNotIn('a', dynperf)
+                    self.assertRaises(ValueError, dynperf.iter_chunks, 0)
+
+                    # writes in between must not be blocked by the scan
+                    for ele, new in zip(dynperf, elements[4000:]):
+                        dynperf.Insert(new)
+                    self.assertEqual(len(dynperf), 4500)
+
+                bitmap = DynPerf.from_keys(range(0, 30000, 7), 30000, storage='bitmap')
+                self.assertEqual(sorted(bitmap), list(range(0, 30000, 7)))
+                self.assertEqual(len(list(bitmap.iter_chunks(100))), 43)
+                self.assertEqual(list(DynPerf(100)), [])
+
+    def test_journal(self):
+        elements = random.sample(range(2 ** 40), 6000)
+        for numpy in (np, None):
+            with using_numpy(numpy):
+                with tempfile.TemporaryDirectory() as directory:
+                    journal = os.path.join(directory, 'journal')
+                    snapshot = os.path.join(directory, 'snapshot')
+                    dynperf = DynPerf(2 ** 40, journal=journal, group_commit=100)
+                    for ele in elements[:2000]:
+                        dynperf.Insert(ele)
+                    dynperf.delete_many(elements[:500])
+                    if numpy is not None:
+                        dynperf.checkpoint(snapshot)
+                    dynperf.insert_many(elements[2000:4000])
+                    for ele in elements[500:1000]:
+                        dynperf.Delete(ele)
+                    dynperf.Insert(elements[0])
+                    dynperf.flush()
+                    # records that never made it into a frame are lost
+                    dynperf.Insert(elements[5999])
+                    # as is a frame the crash cut short
+                    with open(journal, 'ab') as damaged:
+                        damaged.write(b'\x40\x00\x00\x00\x00')
+
+                    expected = set(elements[1000:4000]) | {elements[0]}
+                    recovered = DynPerf.recover(snapshot, journal, incremental=True)
+                    self.assertEqual(recovered.count, len(expected))
+                    self.assertEqual(sorted(recovered), sorted(expected))
+
+                    # the recovered structure keeps journaling
+                    recovered.Delete(elements[0])
+                    recovered.close()
+                    recovered = DynPerf.recover(snapshot, journal)
+                    self.assertEqual(sorted(recovered), sorted(expected - {elements[0]}))
+
+                    self.assertRaises(ValueError, DynPerf, 2 ** 40, journal=journal)
+                    self.assertRaises(ValueError, DynPerf, 2 ** 40, fsync='sometimes',
+                                      journal=os.path.join(directory, 'other'))
+
+    def test_journal_widen(self):
+        '''Recovery after widen_universe, with and without a checkpoint in between'''
+        with tempfile.TemporaryDirectory() as directory:
+            journal = os.path.join(directory, 'journal')
+            snapshot = os.path.join(directory, 'snapshot')
+            for checkpoint in (False, True):
+                with DynPerf(1000, journal=journal, group_commit=1) as dynperf:
+                    dynperf.insert_many(range(0, 1000, 7))
+                    dynperf.widen_universe(10 ** 6)
+                    dynperf.Insert(5000)
+                    if checkpoint:
+                        dynperf.checkpoint(snapshot)
+                    dynperf.Insert(6000)
+                self.assertIsNone(dynperf.journal)
+                expected = sorted(dynperf)
+
+                recovered = DynPerf.recover(snapshot, journal)
+                self.assertEqual(recovered.universe_size, 10 ** 6)
+                self.assertEqual(sorted(recovered), expected)
+                recovered.Insert(7000)
+                recovered.close()
+                with DynPerf.recover(snapshot, journal) as recovered:
+                    self.assertEqual(sorted(recovered), expected + [7000])
+                os.remove(journal)
+
+            # checkpoints can't hold the bitmap
+            for storage in ('auto', 'bitmap'):
+                self.assertRaises(ValueError, DynPerf, 1000, storage=storage, journal=journal)
+                self.assertRaises(ValueError, DynPerf.recover, snapshot, journal, storage=storage)
+
+    def test_journal_bulk(self):
+        '''The keys of from_keys, load and thaw are in the journal'''
+        with tempfile.TemporaryDirectory() as directory:
+            journal = os.path.join(directory, 'journal')
+            missing = os.path.join(directory, 'missing')
+            snapshot = os.path.join(directory, 'snapshot')
+            for numpy in (np, None):
+                with using_numpy(numpy):
+                    with DynPerf.from_keys([1, 2, 3], 1000, journal=journal) as dynperf:
+                        dynperf.Insert(4)
+                        dynperf.save(snapshot)
+                    with DynPerf.recover(missing, journal) as recovered:
+                        self.assertEqual(sorted(recovered), [1, 2, 3, 4])
+                    os.remove(journal)
+
+                    with DynPerf.load(snapshot, journal=journal):
+                        pass
+                    with DynPerf.recover(missing, journal) as recovered:
+                        self.assertEqual(sorted(recovered), [1, 2, 3, 4])
+                    os.remove(journal)
+
+                    with DynPerf.from_keys([5, 6], 1000).freeze().thaw(journal=journal):
+                        pass
+                    with DynPerf.recover(missing, journal) as recovered:
+                        self.assertEqual(sorted(recovered), [5, 6])
+                    os.remove(journal)
+
+    def test_checkpoint_crash(self):
+        '''A crash between the snapshot rename and the journal reset keeps the later writes'''
+        with tempfile.TemporaryDirectory() as directory:
+            journal = os.path.join(directory, 'journal')
+            snapshot = os.path.join(directory, 'snapshot')
+            dynperf = DynPerf(1000, journal=journal)
+            dynperf.Insert(5)
+            dynperf.flush()
+            dynperf.Delete(5)
+
+            def crash():
+                raise KeyboardInterrupt
+            dynperf.journal.reset = crash
+            self.assertRaises(KeyboardInterrupt, dynperf.checkpoint, snapshot)
+            # gone without committing what is still buffered
+            os.close(dynperf.journal.fd)
+
+            with DynPerf.recover(snapshot, journal) as recovered:
+                self.assertFalse(recovered.Locate(5))
+                self.assertEqual(recovered.count, 0)
+
+    def test_escalation(self):
+        module = __import__('dynamic-perfect-hashing')
+        elements = random.sample(range(2 ** 40), 300)
+        star_star_holds = DynPerf.star_star_holds
+
+        # (**) only holds once M has been doubled twice
+        def stubborn(dynperf, total_space, s, M):
+            return (M >= 4 * dynperf.calculate_m(dynperf.count) and
+                    star_star_holds(dynperf, total_space, s, M))
+
+        for numpy in (np, None):
+            with using_numpy(numpy):
+                for incremental in (False, True):
+                    reported = []
+                    dynperf = DynPerf(2 ** 40, incremental=incremental,
+                                      on_escalation=lambda owner, action: reported.append(action))
+                    for ele in elements[:200]:
+                        dynperf.Insert(ele)
+                    dynperf.finish_migration()
+                    prime = dynperf.prime
+
+                    DynPerf.star_star_holds = stubborn
+                    try:
+                        if incremental:
+                            dynperf.start_migration()
+                            dynperf.finish_migration()
+                        else:
+                            dynperf.rehash_with(())
+                    finally:
+                        DynPerf.star_star_holds = star_star_holds
+
+                    self.assertEqual(reported, ['grow_s', 'larger_prime', 'switch_family',
+                                                'grow_M', 'grow_M'])
+                    self.assertEqual(dynperf.statistics()['escalations'],
+                                     {'grow_s': 1, 'larger_prime': 1, 'switch_family': 1,
+                                      'grow_M': 2})
+                    self.assertGreater(dynperf.prime, prime)
+                    self.assertIs(dynperf.hash_family, module.MultiplyShiftHashFunction)
+                    self.assertGreaterEqual(dynperf.M, 4 * dynperf.calculate_m(200))
+
+                    for ele in elements[200:]:
+                        dynperf.Insert(ele)
+                    dynperf.delete_many(elements[:50])
+                    dynperf.finish_migration()
+                    expected = [ele in set(elements[50:]) for ele in elements]
+                    self.assertEqual([dynperf.Locate(ele) for ele in elements], expected)
+                    self.assertEqual(list(dynperf.locate_many(elements)), expected)
+                    dynperf.check_space_total()
+
+        # with a fixed multiplier multiples of 48 collide until the subtable is
+        # large enough to tell them apart
+        family = vars(module.HashFunction)
+        draw, draw_many = family['draw'], family['draw_many']
+        module.HashFunction.draw = staticmethod(lambda prime: 1)
+        module.HashFunction.draw_many = staticmethod(
+            lambda rng, prime, size: np.ones(size, dtype=np.uint64))
+        try:
+            dynperf = DynPerf(2 ** 40)
+            hash_function = dynperf.find_injective([48 * i for i in range(16)], 48)
+            self.assertEqual(hash_function.allocated_space, 768)
+            self.assertEqual(dynperf.escalations['enlarge_sub_table'], 4)
+
+            with using_numpy(None):
+                hash_function = dynperf.find_injective([0, 48], 24)
+            self.assertEqual(hash_function.allocated_space, 96)
+            self.assertEqual(dynperf.escalations['enlarge_sub_table'], 6)
+
+            k, space, values, location, attempts = module.build_sub_tables(
+                np.array([0, 48, 5], dtype=np.uint64), np.array([2, 1]), dynperf.prime, 1,
+                module.HashFunction)
+            self.assertEqual(space.tolist(), [96, 4])
+            self.assertEqual(attempts.tolist(), [65, 1])
+            self.assertEqual(values[location].tolist(), [0, 48, 5])
+        finally:
+            module.HashFunction.draw, module.HashFunction.draw_many = draw, draw_many
+
+    def test_freeze(self):
+        module = __import__('dynamic-perfect-hashing')
+        elements = random.sample(range(2 ** 40), 3000)
+        expected = [ele in set(elements[500:2000]) for ele in elements]
+        for family in ('carter-wegman', 'multiply-shift'):
+            for numpy in (np, None):
+                with using_numpy(numpy):
+                    dynperf = DynPerf(2 ** 40, hash_family=family)
+                    for ele in elements[:2000]:
+                        dynperf.Insert(ele)
+                    for ele in elements[:500]:
+                        dynperf.Delete(ele)
+                    frozen = dynperf.freeze()
+
+                    self.assertIsInstance(frozen, module.FrozenPerfectHash)
+                    self.assertFalse(hasattr(frozen, 'Insert'))
+                    self.assertEqual(len(frozen), 1500)
+                    self.assertEqual([frozen.Locate(ele) for ele in elements], expected)
+                    self.assertEqual(list(frozen.locate_many(elements)), expected)
+                    self.assertEqual(sorted(frozen), sorted(elements[500:2000]))
+                    self.assertIn(elements[1000], frozen)
+                    self.assertNotIn(2 ** 41, frozen)
+                    self.assertRaises(ValueError, frozen.Locate, 2 ** 40 + 1)
+                    # only the live regions of the pool
+                    self.assertEqual(len(frozen.values), sum(dynperf.sub_table_space))
+                    self.assertLess(len(frozen.values), len(dynperf.pool.values))
+
+                    thawed = frozen.thaw()
+                    self.assertIs(thawed.hash_family, dynperf.hash_family)
+                    self.assertEqual([thawed.Locate(ele) for ele in elements], expected)
+                    thawed.Insert(elements[0])
+                    self.assertTrue(thawed.Locate(elements[0]))
+                    self.assertFalse(frozen.Locate(elements[0]))
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'frozen')
+            frozen.save(path)
+            for mmap in (True, False):
+                loaded = module.FrozenPerfectHash.load(path, mmap=mmap)
+                self.assertIs(loaded.family, frozen.family)
+                self.assertEqual(len(loaded), 1500)
+                self.assertEqual(list(loaded.locate_many(elements)), expected)
+                self.assertEqual([loaded.Locate(ele) for ele in elements[:100]], expected[:100])
+                del loaded
+        unpickled = pickle.loads(pickle.dumps(frozen))
+        self.assertEqual(list(unpickled.locate_many(elements)), expected)
+        self.assertRaises(ValueError, module.FrozenPerfectHash.from_buffer, bytes(200))
+
+        empty = DynPerf(100).freeze()
+        self.assertEqual(len(empty), 0)
+        self.assertFalse(empty.Locate(0))
+        self.assertFalse(empty.Locate(100))
+        self.assertEqual(list(empty.locate_many([0, 5, 100])), [False] * 3)
+        self.assertEqual(list(empty), [])
+        self.assertRaises(NotImplementedError, DynPerf(100, storage='bitmap').freeze)
+        self.assertRaises(NotImplementedError, PerfectHashMap(100).freeze)
+
     def test_full(self):
         '''Full integration test by randoming 1 million values'''
         count = int(1E6)
-        # Our prime calculation method is really naive, so can't have a very
-        # large universe size
-        universe_size = 5000
-        elements = [random.randrange(0, universe_size) for _ in range(count)]
+        universe_size = 2 ** 63
+        # a fifth of them distinct, so Insert and Delete also see duplicates
+        keys = [random.randrange(0, universe_size) for _ in range(count // 5)]
+        elements = [random.choice(keys) for _ in range(count)]
 
         dynperf = DynPerf(universe_size)
 